@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+from utils.heap import RUN_FORMATIONS, Heap, parallel_runs
+
+from methods.p_ways import PWays
+from methods.cascade import Cascade
+from methods.polyphasic import Polyphasic
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from typing import *
+
+def _uniform(rng: random.Random, n: int) -> List[int]:
+    return [rng.randint(0, 1_000_000) for _ in range(n)]
+
+def _sorted(rng: random.Random, n: int) -> List[int]:
+    return sorted(_uniform(rng, n))
+
+def _reversed(rng: random.Random, n: int) -> List[int]:
+    return sorted(_uniform(rng, n), reverse=True)
+
+def _nearly_sorted(rng: random.Random, n: int) -> List[int]:
+    # sorted, but for one register in a thousand swapped with a random one
+    registers = _sorted(rng, n)
+    for _ in range(n // 1000):
+        i, j = rng.randrange(n), rng.randrange(n)
+        registers[i], registers[j] = registers[j], registers[i]
+    return registers
+
+def _few_unique(rng: random.Random, n: int) -> List[int]:
+    return [rng.randint(0, 10) for _ in range(n)]
+
+DISTRIBUTIONS: Dict[str, Callable[[random.Random, int], List[int]]] = {
+    "uniform": _uniform,
+    "sorted": _sorted,
+    "reversed": _reversed,
+    "nearly_sorted": _nearly_sorted,
+    "few_unique": _few_unique,
+}
+
+def make_registers(n: int, distribution: str, seed: int = 0) -> List[int]:
+    return DISTRIBUTIONS[distribution](random.Random(seed), n)
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process, in MiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def _result(name: str, params: Dict[str, Any], records: int, elapsed: float, **extra) -> Dict[str, Any]:
+    return {
+        "name": name,
+        "params": params,
+        "records": records,
+        "seconds": elapsed,
+        "records_per_sec": records / elapsed if elapsed > 0 else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        **extra,
+    }
+
+def bench_runs(formation: str, n: int, m: int, distribution: str = "uniform", seed: int = 0) -> Dict[str, Any]:
+    """
+    Times the run generation of `n` registers by `formation` (a name of
+    `RUN_FORMATIONS`: `Heap.sort`, `LoadSortStore.sort`...) with a main
+    memory of `m` registers (`m` distinct values for "counting").
+    """
+    registers = make_registers(n, distribution, seed)
+
+    start_time = time.perf_counter()
+    sorted_sequences = RUN_FORMATIONS[formation](main_memory_size=m, registers=registers).sort()
+    elapsed = time.perf_counter() - start_time
+
+    return _result(formation, {"n": n, "m": m, "distribution": distribution}, n, elapsed, runs=len(sorted_sequences))
+
+def bench_parallel_heap(n: int, m: int, workers: int, distribution: str = "uniform", seed: int = 0) -> Dict[str, Any]:
+    """
+    Times `parallel_runs` over `n` registers on `workers` processes, run
+    files included.
+    """
+    registers = make_registers(n, distribution, seed)
+    run_dir = tempfile.mkdtemp()
+
+    start_time = time.perf_counter()
+    with parallel_runs(registers, m, run_dir, workers=workers) as manifest:
+        num_runs = len(manifest)
+    elapsed = time.perf_counter() - start_time
+    shutil.rmtree(run_dir)
+
+    return _result("parallel_heap", {"n": n, "m": m, "workers": workers, "distribution": distribution}, n, elapsed, runs=num_runs)
+
+def bench_merge(n: int, k: int, distribution: str = "uniform", seed: int = 0) -> Dict[str, Any]:
+    """
+    Times `PWays.merge_p_lists` over `k` sorted runs holding `n` registers in total.
+    """
+    registers = make_registers(n, distribution, seed)
+    runs = [sorted(registers[i::k]) for i in range(k)]
+
+    start_time = time.perf_counter()
+    PWays.merge_p_lists(runs)
+    elapsed = time.perf_counter() - start_time
+
+    return _result("merge_p_lists", {"n": n, "k": k, "distribution": distribution}, n, elapsed)
+
+def bench_merge_2(n: int, distribution: str = "uniform", seed: int = 0) -> Dict[str, Any]:
+    """
+    Times `PWays.merge_2_lists` over two sorted runs holding `n` registers in total.
+    """
+    registers = make_registers(n, distribution, seed)
+    left, right = sorted(registers[0::2]), sorted(registers[1::2])
+
+    start_time = time.perf_counter()
+    PWays.merge_2_lists(left, right)
+    elapsed = time.perf_counter() - start_time
+
+    return _result("merge_2_lists", {"n": n, "distribution": distribution}, n, elapsed)
+
+def bench_cascade_merge(n: int, m: int, k: int, distribution: str = "uniform", seed: int = 0) -> Dict[str, Any]:
+    """
+    Times the `Cascade.merge_files` calls of the first step of a cascade
+    over the runs of `n` registers.
+    """
+    registers = make_registers(n, distribution, seed)
+    sorted_sequences = Heap(main_memory_size=m, registers=registers).sort()
+    cascade = Cascade(registers=sorted_sequences, max_open_files=k, main_memory_size=m, verbose=False)
+
+    out_idx = cascade._empty_file_idx()
+    inputs = [i for i in range(k) if i != out_idx]
+    n_merges = min(len(cascade._files[i]) for i in inputs)
+
+    records = 0
+    start_time = time.perf_counter()
+    for _ in range(n_merges):
+        records += len(cascade.merge_files(inputs))
+    elapsed = time.perf_counter() - start_time
+    cascade.close()
+
+    return _result("cascade_merge_files", {"n": n, "m": m, "k": k, "distribution": distribution}, records, elapsed, merges=n_merges)
+
+def bench_sort(method: str, n: int, m: int, k: int, distribution: str = "uniform",
+               tape_dir: Optional[str] = None, seed: int = 0, counted: bool = False,
+               compress: bool = False) -> Dict[str, Any]:
+    """
+    Times the full `sort()` of `method` ("B", "P" or "C") over the runs of
+    `n` registers (the run generation is timed by `bench_runs`), without
+    printing the phases. With `counted` the runs are (value, count) entries,
+    and with `compress` the tapes (on disk) are delta + varint encoded.
+    """
+    registers = make_registers(n, distribution, seed)
+    sorted_sequences = Heap(main_memory_size=m, registers=registers).sort()
+    r = len(sorted_sequences)
+
+    start_time = time.perf_counter()
+    match method:
+        case 'B':
+            algoritmo = PWays(m, r, k, sorted_sequences=sorted_sequences, tape_dir=tape_dir, verbose=False, counted=counted, compress=compress)
+            alpha = algoritmo.sort()
+        case 'P':
+            algoritmo = Polyphasic([], m, r, k, tape_dir=tape_dir, counted=counted, compress=compress)
+            _, alpha, _ = algoritmo.sort(data=sorted_sequences, verbose=False)
+        case 'C':
+            algoritmo = Cascade(registers=sorted_sequences, max_open_files=k, main_memory_size=m, tape_dir=tape_dir, verbose=False, counted=counted, compress=compress)
+            alpha = algoritmo.sort()
+        case _:
+            raise ValueError(f"O método `{method}` não existe.")
+    elapsed = time.perf_counter() - start_time
+
+    phase_seconds = list(algoritmo.seconds_per_phase)
+    compression = [phase.compression_ratio for phase in algoritmo.stats.phases]
+    algoritmo.close()
+    params = {"method": method, "n": n, "m": m, "k": k, "distribution": distribution, "on_disk": tape_dir is not None}
+    extra: Dict[str, Any] = {}
+    if counted:
+        params["counted"] = True
+    if compress:
+        params["compress"] = True
+        extra["compression"] = compression
+    return _result("sort", params, n, elapsed, runs=r, alpha=alpha, phase_seconds=phase_seconds, **extra)
+
+def run_isolated(bench: Callable[..., Dict[str, Any]], *args, **kwargs) -> Dict[str, Any]:
+    """
+    Runs `bench` in a fresh process, so its peak RSS is its own.
+    """
+    with ProcessPoolExecutor(1) as pool:
+        return pool.submit(bench, *args, **kwargs).result()
+
+def measure(case: Tuple, repeat: int, previous: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Runs `case`, a (bench, args, kwargs) triple, `repeat` times and keeps
+    the fastest run (of those and of a `previous` measure). Its "noise" is
+    the spread of the throughputs: how much slower the slowest run was.
+    """
+    bench, args, kwargs = case
+    runs = [run_isolated(bench, *args, **kwargs) for _ in range(repeat)]
+    throughputs = [run["records_per_sec"] for run in runs]
+    if previous is not None:
+        runs.append(previous)
+        throughputs += previous["samples"]
+    result = dict(max(runs, key=lambda run: run["records_per_sec"]))
+    result["noise"] = 1 - min(throughputs) / max(throughputs) if max(throughputs) else 0.0
+    result["samples"] = throughputs
+    return result
+
+def result_key(result: Dict[str, Any]) -> str:
+    return result["name"] + " " + " ".join(f"{k}={v}" for k, v in sorted(result["params"].items()))
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    """
+    Returns the benchmarks whose throughput dropped more than `tolerance`
+    (a fraction) below the one of `baseline`, plus the noise measured on
+    either side: a drop within the spread of the repeated runs is not a
+    regression.
+    """
+    previous = {result_key(result): result for result in baseline}
+    regressions: List[str] = []
+    for result in results:
+        key = result_key(result)
+        if key not in previous or not previous[key]["records_per_sec"]:
+            continue
+        ratio = result["records_per_sec"] / previous[key]["records_per_sec"]
+        noise = max(result.get("noise", 0.0), previous[key].get("noise", 0.0))
+        print(f"{key}: {ratio:.2f}x baseline (noise {noise:.0%})")
+        if ratio < 1 - tolerance - noise:
+            regressions.append(key)
+    return regressions
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--n-registers",      type=int, nargs='+', default=[100_000])
+    parser.add_argument("-m", "--main-memory-size", type=int, nargs='+', default=[60])
+    parser.add_argument("-k", "--max-open-files",   type=int, nargs='+', default=[4, 8])
+    parser.add_argument("-d", "--distributions",    type=str, nargs='+', default=list(DISTRIBUTIONS), choices=list(DISTRIBUTIONS))
+    parser.add_argument("-M", "--methods",          type=str, nargs='+', default=["B", "P", "C"], choices=["B", "P", "C"])
+    parser.add_argument("-j", "--jobs",             type=int, nargs='+', default=[],
+                        help="Also time the parallel run generation on each number of JOBS.")
+    parser.add_argument("-t", "--tape-dir",         type=str, default=None,
+                        help="Also run the full sorts with the files on disk, under TAPE_DIR.")
+    parser.add_argument("-C", "--counted",          action="store_true", help="Also run the full sorts over counted runs.")
+    parser.add_argument("-z", "--compress",         action="store_true", help="Also run the full sorts on disk (--tape-dir) over compressed tapes.")
+    parser.add_argument("-r", "--repeat",           type=int, default=3, help="Keep the fastest of REPEAT runs of each benchmark.")
+    parser.add_argument("-o", "--output",           type=str, default=None, help="Write the results to OUTPUT (JSON).")
+    parser.add_argument("-b", "--baseline",         type=str, default=None, help="Compare the results with a previous OUTPUT.")
+    parser.add_argument("--tolerance",              type=float, default=0.1,
+                        help="Throughput drop, as a fraction of the baseline, reported as a regression "
+                             "(on top of the noise of the repeated runs, and only if it shows again when measured again).")
+    args = parser.parse_args()
+
+    # options of each full sort, on top of the in-memory one
+    sort_options: List[Dict[str, Any]] = [{}]
+    if args.tape_dir is not None:
+        sort_options.append({"tape_dir": args.tape_dir})
+        if args.compress:
+            sort_options.append({"tape_dir": args.tape_dir, "compress": True})
+    if args.counted:
+        sort_options.append({"counted": True})
+
+    # (bench, args, kwargs) of every benchmark
+    cases: List[Tuple] = []
+    for n in args.n_registers:
+        for d in args.distributions:
+            cases.append((bench_merge_2, (n, d), {}))
+            for m in args.main_memory_size:
+                cases.extend((bench_runs, (formation, n, m, d), {}) for formation in RUN_FORMATIONS)
+                cases.extend((bench_parallel_heap, (n, m, workers, d), {}) for workers in args.jobs)
+            for k in args.max_open_files:
+                cases.append((bench_merge, (n, k, d), {}))
+                for m in args.main_memory_size:
+                    cases.append((bench_cascade_merge, (n, m, k, d), {}))
+                    cases.extend((bench_sort, (method, n, m, k, d), options) for method in args.methods for options in sort_options)
+
+    results: List[Dict[str, Any]] = []
+    for case in cases:
+        result = measure(case, args.repeat)
+        print(f"{result_key(result)}: {result['seconds']:.3f}s ({result['records_per_sec']:,.0f} registers/s, "
+              f"noise {result['noise']:.0%}, peak RSS {result['peak_rss_mb']:.1f} MiB)")
+        results.append(result)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            # a slow run may be a busy machine: the suspects are measured again before being reported
+            print(f"Measuring {len(regressions)} possible regression(s) again...")
+            for i, result in enumerate(results):
+                if result_key(result) in regressions:
+                    results[i] = measure(cases[i], args.repeat, result)
+            regressions = compare([result for result in results if result_key(result) in regressions], baseline, args.tolerance)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version, "results": results}, f, indent=2)
+
+    if args.baseline is not None and regressions:
+        print(f"[!] {len(regressions)} regression(s) over {args.tolerance:.0%}:", *regressions, sep="\n    ")
+        sys.exit(1)
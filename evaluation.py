@@ -2,24 +2,54 @@
 
 from logging import debug
 from matplotlib.font_manager import generate_fontconfig_pattern
-from utils.heap import Heap
-from utils.utils import togglePrint, beta
+from utils.heap import RUN_FORMATIONS
+from utils.utils import beta
 
 from methods.p_ways import PWays
 from methods.cascade import Cascade
 from methods.polyphasic import Polyphasic
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
 import os
 import random
+import sys
 import time, datetime
+import traceback
 from typing import *
 
 from tqdm import tqdm
 
 import matplotlib.pyplot as plt
 
+REPETITIONS = 10
+
+def task_seed(seed: int, algoritmo: str, m: int, k: int, r: int, repetition: int) -> int:
+    """
+    Seed of one run of a sweep. It only depends on the run itself, so the
+    results are the same whatever the number of workers or the order the
+    runs finish in.
+    """
+    key = f"{seed}:{algoritmo}:{m}:{k}:{r}:{repetition}".encode()
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], "little")
+
+def _run_task(algoritmo: str, r: int, m: int, k: int, seed: int, dry_run: bool = False) -> float:
+    """
+    One run of a sweep, on a worker process (or inline with one worker).
+    """
+    if dry_run:
+        return Evaluator.simulate_once(algoritmo, r, m, k, random.Random(seed))
+    return Evaluator.run_once(algoritmo, r, m, k, random.Random(seed))
+
 class Evaluator():
-    def __init__(self, algoritmo: Literal["B", "P", "C"], output_path: Optional[str] = None) -> None:
+    def __init__(
+        self,
+        algoritmo: Literal["B", "P", "C"],
+        output_path: Optional[str] = None,
+        workers: int = 1,
+        seed: int = 0,
+        dry_run: bool = False,
+    ) -> None:
         self.algoritmo = algoritmo.upper()
         assert self.algoritmo in ("B","P","C"), f"Algoritmo não reconhecido: `{self.algoritmo}`"
         print(f"Running with {self.get_alg_name()} sort.")
@@ -27,26 +57,39 @@ class Evaluator():
         self.output_path = output_path
         assert os.path.isdir(self.output_path), "Please select a directory as an output path."
 
+        # The runs of a sweep go to a pool of `workers` processes, each one
+        # with its own seed derived from `seed` (see `task_seed`).
+        self.workers = workers
+        self.seed = seed
+        # Simulate the sorts from the run lengths (`simulate` of each method) instead of sorting the registers
+        self.dry_run = dry_run
+
     @staticmethod
-    def _generate_random_sequence(size: Optional[int | Tuple[int,int]] = None, low=0, high=100) -> List[int]:
+    def _generate_random_sequence(size: Optional[int | Tuple[int,int]] = None, low=0, high=100, rng: random.Random = random) -> List[int]:
         if size is None:
-            size = random.randint(4,10)
+            size = rng.randint(4,10)
         elif type(size) == tuple:
-            size = random.randint(size[0], size[1])
+            size = rng.randint(size[0], size[1])
 
         assert type(size) == int, "Unreachable."
-        return [random.randint(low, high) for _ in range(size)]
+        return [rng.randint(low, high) for _ in range(size)]
 
     @staticmethod
-    def _generate_ordered_runs(size = None, low=0, high=100, main_memory_size=3, max_seq_len=5):
-        runs = Evaluator._generate_random_runs(size, low,  high, main_memory_size, max_seq_len)
+    def _generate_ordered_runs(size = None, low=0, high=100, main_memory_size=3, max_seq_len=5, rng: random.Random = random):
+        runs = Evaluator._generate_random_runs(size, low,  high, main_memory_size, max_seq_len, rng)
         [x.sort() for x in runs]
         return runs
 
     @staticmethod
-    def _generate_random_runs(size = None, low=0, high=100, main_memory_size=3, max_seq_len=5) -> List[List[int]]:
-        size = size if size is not None else random.randint(4, 10)
-        return [Evaluator._generate_random_sequence(random.randint(main_memory_size, max_seq_len), low, high) for _ in range(size)]
+    def _generate_run_lengths(size = None, main_memory_size=3, max_seq_len=5, rng: random.Random = random) -> List[int]:
+        size = size if size is not None else rng.randint(4, 10)
+        return [rng.randint(main_memory_size, max_seq_len) for _ in range(size)]
+
+    @staticmethod
+    def _generate_random_runs(size = None, low=0, high=100, main_memory_size=3, max_seq_len=5, rng: random.Random = random) -> List[List[int]]:
+        # The lengths are drawn first, so a dry run gets the same ones from the same seed
+        lengths = Evaluator._generate_run_lengths(size, main_memory_size, max_seq_len, rng)
+        return [Evaluator._generate_random_sequence(length, low, high, rng) for length in lengths]
 
     def get_alg_name(self):
         match (self.algoritmo):
@@ -85,11 +128,14 @@ class Evaluator():
         plt.savefig(fpath)
         print(f"Done. Saved to `{fpath}`.")
     
-    def run_with_r_sequences(self, r: int, m: int, k: int) -> float:
-        togglePrint() # Disable printing
-
-        if self.algoritmo == "B":
-            initial_sequences = self._generate_random_runs(r, main_memory_size=m)
+    @staticmethod
+    def run_once(algoritmo: str, r: int, m: int, k: int, rng: random.Random = random) -> float:
+        """
+        Sorts `r` random runs with `algoritmo`, without printing, and returns
+        its `alpha` (-1 if the sort failed).
+        """
+        if algoritmo == "B":
+            initial_sequences = Evaluator._generate_random_runs(r, main_memory_size=m, rng=rng)
 
             alg = PWays(
                 main_memory_size=m,
@@ -97,11 +143,12 @@ class Evaluator():
                 max_open_files=k,
                 sorted_sequences=initial_sequences,
                 save_results=False,
-                is_inputing_sorted_sequences=True
+                is_inputing_sorted_sequences=True,
+                verbose=False,
             )
 
-        elif self.algoritmo == 'P':
-            initial_sequences = Evaluator._generate_ordered_runs(size=r, main_memory_size=m)
+        elif algoritmo == 'P':
+            initial_sequences = Evaluator._generate_ordered_runs(size=r, main_memory_size=m, rng=rng)
 
             alg = Polyphasic(
                 registers=[],
@@ -110,64 +157,124 @@ class Evaluator():
                 max_open_files=k,
             )
 
-            _, alpha, _ = alg.sort(data=initial_sequences, verbose=False)
-            togglePrint() # Re-enable printing
-
-            return alpha
-
         else: # Cascade
-            seqs = Evaluator._generate_ordered_runs(size=r)
+            seqs = Evaluator._generate_ordered_runs(size=r, rng=rng)
             alg = Cascade(
                 registers=seqs,
                 main_memory_size=m,
                 max_open_files=k,
-                verbose=True,
+                verbose=False,
             )
 
         try:
-            alpha = alg.sort()
-            togglePrint() # Re-enable printing
+            if algoritmo == 'P':
+                _, alpha, _ = alg.sort(data=initial_sequences, verbose=False)
+            else:
+                alpha = alg.sort()
             return alpha
-        except Exception as e:
-            # In case of error, rerun the algorithm with
-            # printing enabled while using same cfg
-            # to understand what happened.
-            togglePrint() # Re-enable printing
-            alg.sort()
+        except Exception:
+            # Reported on stderr, so the failing cfg can be rerun.
+            print(f"[!] {algoritmo} failed with r={r}, m={m}, k={k}:", file=sys.stderr)
+            traceback.print_exc()
             return -1
 
-        assert False, "Unreachable"
+    @staticmethod
+    def simulate_once(algoritmo: str, r: int, m: int, k: int, rng: random.Random = random) -> float:
+        """
+        Same as `run_once`, but only the run lengths are drawn and the sort
+        is simulated from them: same `alpha` for the same seed.
+        """
+        if algoritmo == "B":
+            return PWays.simulate(Evaluator._generate_run_lengths(r, main_memory_size=m, rng=rng), m, k).alpha
+        elif algoritmo == 'P':
+            return Polyphasic.simulate(Evaluator._generate_run_lengths(r, main_memory_size=m, rng=rng), m, k).alpha
+        else: # Cascade
+            return Cascade.simulate(Evaluator._generate_run_lengths(r, rng=rng), m, k).alpha
+
+    def run_with_r_sequences(self, r: int, m: int, k: int, seed: Optional[int] = None) -> float:
+        rng = random.Random(seed) if seed is not None else random
+        if self.dry_run:
+            return Evaluator.simulate_once(self.algoritmo, r, m, k, rng)
+        return Evaluator.run_once(self.algoritmo, r, m, k, rng)
+
+    def _sweep(self, m: int, k_values: List[int], r_values: List[int]) -> Iterator[Tuple[int, int, float]]:
+        """
+        Runs `REPETITIONS` sorts for every (k, r) and yields `(k, r, mean alpha)`
+        as soon as the last repetition of a pair is done, so in no specific
+        order. With `workers` > 1 the sorts run on a process pool.
+        """
+        tasks = [
+            ((k, r, i), (self.algoritmo, r, m, k, task_seed(self.seed, self.algoritmo, m, k, r, i), self.dry_run))
+            for k in k_values for r in r_values for i in range(REPETITIONS)
+        ]
+        values: Dict[Tuple[int, int], Dict[int, float]] = {}
+
+        def done(key, alpha):
+            k, r, i = key
+            values.setdefault((k, r), {})[i] = alpha
+            if len(values[(k, r)]) == REPETITIONS:
+                # Summed in the order of the repetitions, not the one they finished in
+                alphas = values.pop((k, r))
+                return k, r, sum(alphas[i] for i in range(REPETITIONS)) / REPETITIONS
+
+        with tqdm(total=len(tasks)) as progress:
+            if self.workers <= 1:
+                for key, task in tasks:
+                    result = done(key, _run_task(*task))
+                    progress.update()
+                    if result is not None:
+                        yield result
+                return
+
+            with ProcessPoolExecutor(self.workers) as pool:
+                futures = {pool.submit(_run_task, *task): key for key, task in tasks}
+                for future in as_completed(futures):
+                    result = done(futures[future], future.result())
+                    progress.update()
+                    if result is not None:
+                        yield result
+
+    def _csv_path(self, m: int, k: int, prefix: str = "alpha_test") -> str:
+        if os.path.isdir(self.output_path):
+            return os.path.join(self.output_path, f"{prefix}_{self.get_alg_name()}_m{m}_k{k}.csv")
+        return self.output_path
 
     def test_alpha(self, m: int, k: int, r_values: List[int], save_results: bool = False) -> List[float]:
-        results = []
-
-        start_time = time.perf_counter()
-        for i in tqdm(r_values):
-            values = []
-            for _ in range(10):
-                result = self.run_with_r_sequences(r=i, m=m, k=k)
-                values.append(result)
-            results.append(sum(values)/len(values))
-
-        end_time = time.perf_counter()
-
-        print(f"[!] Ran {len(r_values)} tests in {end_time - start_time} seconds.")
-
+        """
+        Mean `alpha` of `REPETITIONS` sorts for each r. With `save_results`
+        every "r, alpha" line is written as soon as it is known.
+        """
         if save_results:
             assert self.output_path is not None, "You need to define an output dir to be able to save the results."
-            if os.path.isdir(self.output_path):
-                fpath = os.path.join(self.output_path, f"alpha_test_{self.get_alg_name()}_m{m}_k{k}.csv")
-            else:
-                fpath = self.output_path
 
-            print("[!] Saving results...", end=' ')
-            with open(fpath, 'w+') as f:
-                for i in r_values:
-                    f.write(f"{r_values[i]}, {results[i]}\n")
+        return self._test(m, [k], r_values, "alpha_test" if save_results else None)[k]
 
-            print(f"Done. Results saved to `{fpath}`.")
+    def _test(self, m: int, k_values: List[int], r_values: List[int], prefix: Optional[str]) -> Dict[int, List[float]]:
+        """
+        Sweeps every (k, r), streaming the results to one CSV per k if
+        `prefix` is given. Returns the mean alphas of each k, in the order
+        of `r_values`.
+        """
+        files = {k: open(self._csv_path(m, k, prefix), 'w+') for k in k_values} if prefix is not None else {}
+        results: Dict[int, Dict[int, float]] = {k: {} for k in k_values}
 
-        return results
+        start_time = time.perf_counter()
+        try:
+            for k, r, alpha in self._sweep(m, k_values, r_values):
+                results[k][r] = alpha
+                if k in files:
+                    files[k].write(f"{r}, {alpha}\n")
+                    files[k].flush()
+        finally:
+            for f in files.values():
+                f.close()
+        end_time = time.perf_counter()
+
+        print(f"[!] Ran {len(k_values) * len(r_values)} tests in {end_time - start_time} seconds.")
+        for k, f in files.items():
+            print(f"[!] Results of k={k} saved to `{f.name}`.")
+
+        return {k: [results[k][r] for r in r_values] for k in k_values}
 
     def test_k(
         self,
@@ -177,27 +284,17 @@ class Evaluator():
         save_results: bool = False,
         generate_graph: bool = True
     ) -> List[float]:
-        start_time = time.perf_counter()
-        for i in tqdm(k_values):
-            alphas = self.test_alpha(m=m, k=i, r_values=r_values, save_results = False)
-
-            if save_results:
-                assert self.output_path is not None, "You need to define an output dir to be able to save the results."
-                print("[!] Saving results...", end=' ')
-                fpath  = os.path.join(self.output_path, f"m_test_{self.get_alg_name()}_m{m}_k{i}")
-
-                with open(fpath + ".csv", 'w+') as f:
-                    for i in range(len(alphas)):
-                        f.write(f"{r_values[i]}, {alphas[i]}\n")
+        if save_results or generate_graph:
+            assert self.output_path is not None, "You need to define an output dir to be able to save the results."
 
-                print(f"Results of k={i} saved to `{fpath}.csv`.", end=' ')
-                print()
+        alphas_per_k = self._test(m, k_values, r_values, "m_test" if save_results else None)
 
+        for i in k_values:
+            alphas = alphas_per_k[i]
             if generate_graph:
-                assert self.output_path is not None, "You need to define an output dir to be able to save the results."
                 fpath  = os.path.join(self.output_path, f"m_test_{self.get_alg_name()}_m{m}_k{i}")
                 plt.style.use('ggplot')
-                evaluator.generate_graph(
+                self.generate_graph(
                     x = r_values,
                     y = alphas,
                     x_label = r"Nº Sequencias iniciais ($r$)",
@@ -208,10 +305,6 @@ class Evaluator():
                     legend=[f"k={x}" for x in k_values],
                 )
 
-
-        end_time = time.perf_counter()
-        print(f"[!] Ran {len(k_values)} tests in {end_time - start_time} seconds.")
-
         return alphas
 
     def test_k_for_all(
@@ -241,10 +334,17 @@ class Evaluator():
             save_results: bool = False,
             generate_graph: bool = False,
             fixed_seq: bool = False,
-    ) -> None:
-        betas = []
-        heap_results_len = []
-        avg_seq_size = []
+            run_formations: Sequence[str] = tuple(RUN_FORMATIONS),
+    ) -> Dict[str, Dict[str, List[float]]]:
+        """
+        Beta, number and mean size of the sorted sequences and wall time of
+        each run formation strategy (`utils.heap.RUN_FORMATIONS`) for every
+        m, over the same registers. Returns them by strategy.
+        """
+        results = {
+            name: {"beta": [], "runs": [], "avg_seq_size": [], "seconds": []}
+            for name in run_formations
+        }
         if fixed_seq:
             regs = Evaluator._generate_random_sequence(N_OF_REGS)
 
@@ -252,62 +352,69 @@ class Evaluator():
         for m in tqdm(m_values):
             if not fixed_seq:
                 regs = Evaluator._generate_random_sequence(N_OF_REGS)
-            sorted_seqs = Heap(
-                main_memory_size=m,
-                registers=regs
-            ).sort()
+            for name in run_formations:
+                start_time = time.perf_counter()
+                sorted_seqs = RUN_FORMATIONS[name](
+                    main_memory_size=m,
+                    registers=regs
+                ).sort()
+                elapsed = time.perf_counter() - start_time
+
+                result = results[name]
+                result["runs"].append(len(sorted_seqs))
+                result["avg_seq_size"].append(sum([len(x) for x in sorted_seqs])/len(sorted_seqs))
+                result["beta"].append(
+                    beta(m, len(sorted_seqs), N_OF_REGS, depth=0)
+                )
+                result["seconds"].append(elapsed)
 
-            heap_results_len.append(len(sorted_seqs))
-            avg_seq_size.append(sum([len(x) for x in sorted_seqs])/len(sorted_seqs))
-            betas.append(
-                beta(m, len(sorted_seqs), N_OF_REGS, depth=0)
-            )
+        for name in run_formations:
+            result = results[name]
+            print(f"[!] {name}: " + ", ".join(
+                f"m={m_values[i]} beta={result['beta'][i]:.2f} runs={result['runs'][i]} {result['seconds'][i]:.4f}s"
+                for i in range(len(m_values))
+            ))
 
         if save_results:
             assert self.output_path is not None, "You need to define an output dir to be able to save the results."
             print("[!] Saving results...", end=' ')
-            fpath  = os.path.join(self.output_path, f"beta_test_m{m}" if not fixed_seq else f"beta_test_m{m}_fixed")
+            for name in run_formations:
+                fpath  = os.path.join(self.output_path, f"beta_test_{name}_m{m}" if not fixed_seq else f"beta_test_{name}_m{m}_fixed")
 
-            with open(fpath + ".csv", 'w+') as f:
-                for i in range(len(betas)):
-                    f.write(f"{m_values[i]}, {betas[i]}\n")
+                with open(fpath + ".csv", 'w+') as f:
+                    result = results[name]
+                    for i in range(len(m_values)):
+                        f.write(f"{m_values[i]}, {result['beta'][i]}, {result['runs'][i]}, {result['seconds'][i]}\n")
 
-            print(f"Results of k={i} saved to `{fpath}.csv`.", end=' ')
+                print(f"Results of {name} saved to `{fpath}.csv`.", end=' ')
         print()
 
         if generate_graph:
             assert self.output_path is not None, "You need to define an output dir to be able to save the results."
-            fpath  = os.path.join(self.output_path, f"beta_test_m{m}" if not fixed_seq else f"beta_test_m{m}_fixed")
             plt.style.use('ggplot')
+            legend = list(run_formations)
+            graphs = [ # (valor, y_label, y_lim, sufixo)
+                ("beta",         r"$\beta$",                     (0, 4), ""),
+                ("runs",         r"Qtd. Sequências",             None,   "_n_seqs"),
+                ("avg_seq_size", r"Tam. médio das Sequências",   None,   "_avg_seq_size"),
+                ("seconds",      r"Tempo (s)",                   None,   "_seconds"),
+            ]
+            for key, y_label, y_lim, suffix in graphs:
+                fpath  = os.path.join(self.output_path, f"beta_test_m{m}{suffix}" + ("_fixed" if fixed_seq else ""))
+                plt.clf()
+                # Uma curva por estratégia, no mesmo gráfico
+                for name in run_formations:
+                    self.generate_graph(
+                        x       = m_values,
+                        y       = results[name][key],
+                        x_label = r"Tam. da memória principal ($m$)",
+                        y_label = y_label,
+                        y_lim   = y_lim,
+                        fpath   = fpath + '.png',
+                        legend  = legend,
+                    )
 
-            evaluator.generate_graph( # Gráfico para o beta
-                x       = m_values,
-                y       = betas,
-                x_label = r"Tam. da memória principal ($m$)",
-                y_label = r"$\beta$",
-                y_lim   = (0, 4),
-                fpath   = fpath + '.png',
-            )
-
-            fpath  = os.path.join(self.output_path, f"beta_test_m{m}" if not fixed_seq else f"beta_test_m{m}_n_seqs_fixed")
-            plt.clf()
-            evaluator.generate_graph( # Gráfico para o número de sequências
-                x       = m_values,
-                y       = heap_results_len,
-                x_label = r"Tam. da memória principal ($m$)",
-                y_label = r"Qtd. Sequências",
-                fpath   = fpath + '.png',
-            )
-
-            fpath  = os.path.join(self.output_path, f"beta_test_m{m}" if not fixed_seq else f"beta_test_m{m}_avg_seq_size_fixed")
-            plt.clf()
-            evaluator.generate_graph( # Gráfico para o tam. médio de seqs
-                x       = m_values,
-                y       = avg_seq_size,
-                x_label = r"Tam. da memória principal ($m$)",
-                y_label = r"Tam. médio das Sequências",
-                fpath   = fpath + '.png',
-            )
+        return results
 
 
 if __name__ == "__main__":
@@ -319,11 +426,20 @@ if __name__ == "__main__":
     parser.add_argument("-o", "--output",            type=str, default="results/")
     parser.add_argument("-alpha", "--test-alpha",    action="store_true")
     parser.add_argument("-beta", "--test-beta",      action="store_true")
+    parser.add_argument("-j", "--jobs",              type=int, default=1,
+                        help="Run the sorts of the alpha sweep on JOBS processes (one, in this process, by default).")
+    parser.add_argument("-s", "--seed",              type=int, default=0,
+                        help="Seed of the sweep: the same seed gives the same results with any number of JOBS.")
+    parser.add_argument("-n", "--dry-run",           action="store_true",
+                        help="Simulate the sorts of the alpha sweep from the run lengths instead of sorting the registers.")
     args = parser.parse_args()
 
     evaluator = Evaluator(
         algoritmo=args.algorithms,
-        output_path=args.output
+        output_path=args.output,
+        workers=args.jobs,
+        seed=args.seed,
+        dry_run=args.dry_run,
     )
 
     if (not args.test_alpha and not args.test_beta):
@@ -1,61 +1,176 @@
 import argparse
-from typing import List
+from itertools import islice
 import random
+import shutil
+import sys
+import tempfile
 
-from utils.heap import Heap
+from utils.heap import Heap, RUN_FORMATIONS, parallel_runs
+from utils.tape import BLOCK_RECORDS, make_tapes, close_tapes, split_memory
+from utils.utils import read_registers
+from utils.records import RecordLayout
+from utils.keys import FieldKey
+from utils.events import PhasePrinter, SummaryPrinter
 
 from methods.p_ways import PWays
 from methods.polyphasic import Polyphasic
 from methods.cascade import Cascade
 
-def get_valid_registers(sorted_sequences: List[List[int]], r) -> List[int]:
-    valid_registers = []
-    for i in range(r):
-        valid_registers.extend(sorted_sequences[i])
-    return valid_registers
-
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--tape-dir", type=str, default=None,
+                        help="Keep the files on disk, in a scratch directory created under TAPE_DIR.")
+    parser.add_argument("-b", "--block-size", type=int, default=BLOCK_RECORDS,
+                        help="Records per block read from/written to the files on disk.")
+    parser.add_argument("-M", "--memory-budget", type=int, default=None,
+                        help="Main memory (in records) shared by the heap and the buffers of the files on disk.")
+    parser.add_argument("-q", "--io-depth", type=int, default=0,
+                        help="Read ahead and write behind up to IO_DEPTH blocks per file on background threads.")
+    parser.add_argument("-R", "--io-report", action="store_true",
+                        help="Print (to stderr) the stats of each phase: runs, records, comparisons, bytes and time stalled on I/O or merging.")
+    parser.add_argument("-s", "--summary", action="store_true",
+                        help="Print the number and sizes of the sequences of each file instead of their contents.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Generate the sorted sequences (and run the merges of P-Ways) on JOBS processes.")
+    parser.add_argument("-F", "--run-formation", type=str, default="heap", choices=list(RUN_FORMATIONS),
+                        help="Generate the sorted sequences by replacement selection (heap), by sorting each memory load (load-sort), "
+                             "by counting up to m distinct values (counting: a single sequence, and no merge phase, if there are no more) "
+                             "or by replacement selection that skips the heap over ordered stretches (natural: same sequences as heap).")
+    parser.add_argument("-O", "--optimal-merge", action="store_true",
+                        help="P-Ways merges the sequences following a minimum total write plan, shortest first (prints the predicted and actual alpha to stderr).")
+    parser.add_argument("-C", "--counted", action="store_true",
+                        help="Store the sequences as (value, count) entries, so merging the duplicates of a value costs a single entry.")
+    parser.add_argument("-z", "--compress", action="store_true",
+                        help="Delta + varint encode the blocks of the files on disk (needs --tape-dir); -R prints the compression of each phase.")
+    parser.add_argument("--records", action="store_true",
+                        help="Sort the next n lines as records: the key is the first field (an int), the payload the whole line. "
+                             "m and the block size count whole records.")
+    parser.add_argument("--payload-size", type=int, default=None,
+                        help="Store the payloads of the records padded to PAYLOAD_SIZE bytes instead of with their length.")
+    parser.add_argument("--key-columns", type=str, default=None,
+                        help="Sort the lines as records (implies --records) on a composite key over their fields, e.g. "
+                             "\"2:str,1:int:desc,3:float:nulls_last\" (1-based field, type, asc/desc, nulls_first/nulls_last).")
+    args = parser.parse_args()
+    args.records = args.records or args.key_columns is not None
+    if args.counted and args.records:
+        parser.error("--counted only sorts int registers, not records.")
+    if args.compress and (args.tape_dir is None or args.records):
+        parser.error("--compress only encodes int registers on disk (with --tape-dir).")
+
     method = input()
     m, k, r, n = map(int, input().split(' '))
-    registers = list(map(int, input().split(' ')))[:n]
 
-    # if the heap result returns more sorted sequences than expected, get the valid registers
-    heap = Heap(main_memory_size=m, registers=registers)
-    sorted_sequences: List[List[int]] = heap.sort()
-    if len(sorted_sequences) > r:
-        registers:List[int] = get_valid_registers(sorted_sequences, r)
+    layout = None
+    key = None
+    if args.records:
+        layout = RecordLayout(args.payload_size, byte_keys=args.key_columns is not None)
+        # the key is computed once, by the heap, and carried with the line
+        if args.key_columns is not None:
+            try:
+                key = FieldKey(args.key_columns)
+            except ValueError as error:
+                parser.error(str(error))
+        else:
+            key = lambda payload: int(payload.split(maxsplit=1)[0])
+        pad = (lambda line: line.ljust(args.payload_size)) if args.payload_size is not None else (lambda line: line)
+        registers = islice((pad(line.rstrip("\n").encode()) for line in sys.stdin if line.strip()), n)
+    else:
+        # registers are streamed from stdin
+        registers = islice(read_registers(sys.stdin), n)
+
+    block_size = args.block_size
+    if args.memory_budget is not None and args.tape_dir is not None:
+        # two buffers per file (k files plus the one holding the sorted sequences), the rest goes to the heap
+        heap_size, block_size = split_memory(args.memory_budget, k + 1, block_size)
+        if heap_size != m:
+            print(f"[!] Warning: a memory budget of {args.memory_budget} records leaves {heap_size} records to the heap with blocks of {block_size} records. m is now {heap_size}.")
+            m = heap_size
+
+    # the sorted sequences are generated once and handed to the methods
+    sorted_sequences = make_tapes(1, args.tape_dir, block_size, args.io_depth, layout, args.counted, args.compress)[0]
+    if args.jobs > 1 and args.run_formation == "heap" and not args.records:
+        # each process writes the sequences of its chunk of registers to its own run file
+        run_dir = tempfile.mkdtemp(prefix="runs-", dir=args.tape_dir)
+        with parallel_runs(registers, m, run_dir, workers=args.jobs) as manifest:
+            # no view of the run files may outlive the manifest
+            for i in range(len(manifest)):
+                sorted_sequences.append(manifest[i])
+        shutil.rmtree(run_dir)
+    else:
+        heap = RUN_FORMATIONS[args.run_formation](main_memory_size=m, registers=registers, key=key)
+        heap.write_runs([sorted_sequences])
 
-    if len(registers) == 0:
-        registers = [random.randint(0,100) for _ in range(n)]
+    if len(sorted_sequences) == 0:
+        random_registers = (random.randint(0,100) for _ in range(n))
+        if args.records:
+            random_registers = (pad(str(x).encode()) for x in random_registers)
+        Heap(main_memory_size=m, registers=random_registers, key=key).write_runs([sorted_sequences])
+
+    # if the heap result returns more sorted sequences than expected, get the valid registers
+    while len(sorted_sequences) > r:
+        sorted_sequences.pop(-1)
 
     if len(sorted_sequences) < r:
         print(f"[!] Warning: Heap returned only {len(sorted_sequences)} ordered sequences when r={r} was provided. In ordered to not crash, r is now {len(sorted_sequences)}.")
         r = len(sorted_sequences)
-    sorting_algorithm = None
+
+    observer = SummaryPrinter() if args.summary else PhasePrinter()
 
     match(method):
         case 'B':
             algoritmo = PWays(
                 main_memory_size=m,
-                registers=registers,
+                sorted_sequences=sorted_sequences,
                 max_open_files=k,
                 num_sorted_sequences=r,
-                is_inputing_sorted_sequences=False
+                is_inputing_sorted_sequences=True,
+                tape_dir=args.tape_dir,
+                block_size=block_size,
+                io_depth=args.io_depth,
+                observer=observer,
+                workers=args.jobs,
+                optimal_merge=args.optimal_merge,
+                layout=layout,
+                counted=args.counted,
+                compress=args.compress,
             )
+            alpha = algoritmo.sort()
+            if args.optimal_merge:
+                print(f"[!] alpha {alpha:.2f}, predicted {algoritmo.plan.alpha:.2f} by the merge plan", file=sys.stderr)
         case 'P':
             algoritmo = Polyphasic(
                 main_memory_size=m,
-                registers=registers,
+                registers=[],
                 max_open_files=k,
                 num_sorted_sequences=r,
+                tape_dir=args.tape_dir,
+                block_size=block_size,
+                io_depth=args.io_depth,
+                observer=observer,
+                layout=layout,
+                counted=args.counted,
+                compress=args.compress,
             )
+            algoritmo.sort(data=sorted_sequences)
         case 'C':
             algoritmo = Cascade(
                 main_memory_size=m,
-                registers=registers,
+                registers=sorted_sequences,
                 max_open_files=k,
+                tape_dir=args.tape_dir,
+                block_size=block_size,
+                io_depth=args.io_depth,
+                observer=observer,
+                layout=layout,
+                counted=args.counted,
+                compress=args.compress,
             )
+            algoritmo.sort()
         case _:
             raise ValueError(f"O método `{method}` não existe.")
 
-    algoritmo.sort()
+    if args.io_report:
+        print(algoritmo.io_report(), file=sys.stderr)
+
+    algoritmo.close()
+    close_tapes([sorted_sequences])
@@ -4,17 +4,33 @@ import sys
 sys.path.append('..')
 
 from typing import *
-from utils.heap import Heap
+from collections import deque
+from utils.heap import RUN_FORMATIONS
 from utils.utils import beta, argmin
+from utils.tape import BLOCK_RECORDS, IOCounters, Tape, MemoryTape, RecordTape, CountedRun, CountedTape, make_tapes, close_tapes
+from utils.stats import SortSimulation, SortStats
+from utils.events import PhasePrinter, SortObserver
+from utils.runfile import RunFile, RunManifest
+from utils.merge import merge_runs
+from utils.records import KeyExtractor, RecordLayout, record_key, record_str
 
 class Cascade:
     def __init__(
         self,
-        registers: List[int] | List[List[int]],
+        registers: Iterable[int] | List[List[int]] | Tape | MemoryTape | RecordTape | CountedTape | RunFile | RunManifest,
         max_open_files: int,
         main_memory_size:int,
         verbose: bool = True,
         _debug: bool = False,
+        tape_dir: Optional[str] = None,
+        block_size: int = BLOCK_RECORDS,
+        io_depth: int = 0,
+        observer: Optional[SortObserver] = None,
+        run_formation: str = "heap",
+        key: Optional[KeyExtractor] = None,
+        layout: Optional[RecordLayout] = None,
+        counted: bool = False,
+        compress: bool = False,
     ) -> None:
 
         self.max_open_files = max_open_files
@@ -25,18 +41,41 @@ class Cascade:
 
         self.verbose = verbose
         self._debug = _debug
-
-        if type(registers[0]) == int:
-            self.registers = registers
-            self._files = [[] for _ in range(max_open_files)]
-            self._distribute_registers_in_files()
-        else:
-            assert all(type(x) == list for x in registers)
-            self.registers = []
-            for R in registers:
-                self.registers.extend(R)
-            self._files = [[] for _ in range(max_open_files)]
+        # Progress of the sort, printed in the "fase N beta" notation if `verbose` and no other observer is given.
+        self.observer = observer if observer is not None else (PhasePrinter() if verbose else SortObserver())
+
+        # Files live on disk (one tape per file under `tape_dir`, delta + varint encoded with `compress`) or in main memory if `tape_dir` is None.
+        self._tape_dir = tape_dir
+        self._block_size = block_size
+        self._io_depth = io_depth
+        self._compress = compress
+        self._on_disk = tape_dir is not None
+        # With a key extractor (for the registers) or a layout (for the sequences given)
+        # the records are key/payload pairs, merged by key
+        self._key = key
+        self._records = key is not None or layout is not None
+        self._layout = (layout or RecordLayout()) if self._records else None
+        # With `counted` the runs are (value, count) entries (`utils.tape.CountedRun`), merged by value
+        self._counted = counted
+        self._merge_key = record_key if self._records or counted else None
+        self._files = make_tapes(max_open_files, tape_dir, block_size, io_depth, self._layout, counted, compress)
+        # Dummy runs hold no record, so they are only counted: each file holds
+        # its real runs, then `_dummy_runs[i]` dummy ones (see `merge_files`).
+        self._dummy_runs: List[int] = [0] * max_open_files
+        # Comparisons, records, runs, I/O and time of the run generation and of each phase.
+        self.stats = SortStats(self._files)
+
+        self.registers = registers
+        self._num_registers = 0 # Set when distributing the sequences.
+        # How the sorted sequences are generated from `registers` (see `utils.heap.RUN_FORMATIONS`).
+        self._run_formation = RUN_FORMATIONS[run_formation]
+        if isinstance(registers, (Tape, MemoryTape, RecordTape, CountedTape, RunFile, RunManifest)) or (isinstance(registers, list) and registers and type(registers[0]) in (list, CountedRun)):
+            # Initial sequences were given, as lists, on a tape or in run files.
+            assert not isinstance(registers, list) or all(type(x) in (list, CountedRun) for x in registers)
             self._distribute_registers_in_files(sequencias_iniciais=registers)
+        else:
+            # Registers, as a list or any iterable (a file, a generator...).
+            self._distribute_registers_in_files()
 
     @staticmethod
     def _calculate_ideal_previous_line(line: List[int]) -> List[int]:
@@ -65,19 +104,35 @@ class Cascade:
         next_line = [sum(line[:p]) for p in range(1, len(line))]
         return [0] + next_line
 
+    # Ideal distributions already computed, per number of files, from the last
+    # phase (a single run) backwards. Shared by every sort of the process.
+    _ideal_lines: Dict[int, List[List[int]]] = {}
+
     @staticmethod
     def _get_ideal_initial_seq_sizes(n_seqs: int, max_open_files: int, _debug=False) -> List[int]:
-        curr_line = [0] * max_open_files
-        curr_line[-1] = 1
-        if _debug: print(curr_line)
-        while (sum(curr_line) < n_seqs):
-            curr_line = Cascade._calculate_ideal_previous_line(curr_line)
-            if _debug: print(curr_line)
-        return curr_line
+        lines = Cascade._ideal_lines.setdefault(max_open_files, [[0] * (max_open_files - 1) + [1]])
+        while sum(lines[-1]) < n_seqs:
+            lines.append(Cascade._calculate_ideal_previous_line(lines[-1]))
+        # the totals only grow, phase after phase
+        num_lines = next(i for i, line in enumerate(lines, start=1) if sum(line) >= n_seqs)
+        if _debug:
+            for line in lines[:num_lines]:
+                print(line)
+        return list(lines[num_lines - 1])
 
     def _distribute_registers_in_files(self, sequencias_iniciais=None) -> None:
+        self.observer.phase_start(self, self._fase)
+        staging_tape = None
         if sequencias_iniciais is None:
-            sequencias_iniciais = Heap(self.main_memory_size, self.registers).sort()
+            heap = self._run_formation(self.main_memory_size, self.registers, stats=self.stats, key=self._key)
+            if self._on_disk:
+                # The number of sequences is needed before distributing them,
+                # so they are first streamed to a staging tape.
+                staging_tape = make_tapes(1, self._tape_dir, self._block_size, self._io_depth, self._layout, self._counted, self._compress)[0]
+                heap.write_runs([staging_tape])
+                sequencias_iniciais = staging_tape
+            else:
+                sequencias_iniciais = heap.sort()
 
         if self._debug: print("seqs inicias:", sequencias_iniciais)
 
@@ -88,62 +143,60 @@ class Cascade:
         )
 
         write_ops = 0
-        seq_idx = 0
         file_idx = 0
-        while len(sequencias_iniciais) > 0:
-            if tam_inicial_ideal[file_idx % self.max_open_files] == 0 or len(self._files[file_idx % self.max_open_files]) >= tam_inicial_ideal[file_idx % self.max_open_files]:
+        for curr_seq in sequencias_iniciais:
+            # Skips the files that are already full
+            while tam_inicial_ideal[file_idx % self.max_open_files] == 0 or len(self._files[file_idx % self.max_open_files]) >= tam_inicial_ideal[file_idx % self.max_open_files]:
                 file_idx += 1
-                continue
-            curr_seq = sequencias_iniciais.pop(0)
             self._files[file_idx % self.max_open_files].append(curr_seq)
+            self.observer.run_written(self, self._fase, file_idx % self.max_open_files, len(curr_seq))
 
             write_ops += len(curr_seq)
-            seq_idx += 1
             file_idx += 1
 
         for i in range(self.max_open_files):
-            if tam_inicial_ideal[i] == 0:
-                continue
-            n_dummy_runs = tam_inicial_ideal[i] - len(self._files[i])
-            self._files[i].extend([[float('inf')] for _ in range(n_dummy_runs)])
+            if tam_inicial_ideal[i] != 0:
+                self._dummy_runs[i] = tam_inicial_ideal[i] - len(self._files[i])
+
+        self._num_registers = write_ops
+        if staging_tape is not None:
+            close_tapes([staging_tape])
 
         # Do we need to count the number of write ops when first distributing
         # the sequences on files?
         self.write_ops_per_phase.append(0)#(write_ops)
-        self._print_fase()
+        self.stats.num_registers = self._num_registers
+        self.stats.distributed(len(sequencias_iniciais), write_ops)
+        self.stats.end_phase()
+        self._end_fase()
 
-    def _print_fase(self):
+    def format_file(self, i: int, s) -> str:
         """
-        Imprime o estado da fase atual na notação pedida.
+        Sequências de um arquivo, na notação pedida.
         """
-        if not self.verbose:
-            return
-        
-        stringify = lambda s: str(s)[1:-1].replace('[','{').replace(']','}').replace(',', '')
-
-        print(f"fase {self._fase} {self._calculate_current_beta():.2f}")
-        total = 0
-        for i, s in enumerate(self._files):
-            if len(s) == 0:
-                continue
-            line_str  = str(i+1)
-            if self._debug:
-                # Qtd. + tam. das seqs.
-                line_str += '(' + str(len(s)) + (')' if len(s) < 1 else (',' + str(len(s[0])) + ')'))
-                total += sum([len(x) for x in s])
-            line_str += ": " + stringify(s)
-            print(line_str)
-        if self._debug: print("n_total_seqs:", total)
+        line_str = str(i+1)
+        if self._debug:
+            # Qtd. + tam. das seqs.
+            line_str += '(' + str(len(s)) + (')' if len(s) < 1 else (',' + str(len(s[0])) + ')'))
+        return line_str + ": " + ' '.join('{' + ' '.join(map(record_str, seq)) + '}' for seq in s)
 
+    def _end_fase(self):
+        """
+        Reports the end of the current phase to the observer.
+        """
+        self.observer.phase_end(self, self._fase, self._calculate_current_beta())
         self._fase+=1
+        # Printing the files is not part of the sort.
+        self.stats.exclude()
 
     def _calculate_alpha(self) -> float:
-        alpha = (sum(self.write_ops_per_phase) / len(self.registers)) if len(self.registers) != 0 else .0
+        alpha = (sum(self.write_ops_per_phase) / self._num_registers) if self._num_registers != 0 else .0
         return alpha
 
     def get_beta_at_phase(self, phase: int = -1) -> float:
         """
         NOTE: If `phase` is not specified, considers the last phase calculated.
+        Dummy runs hold no record, so they are not counted as sequences.
         """
 
         assert -1 <= phase < len(self.write_ops_per_phase), f"There is no phase `{phase}`"
@@ -165,68 +218,186 @@ class Cascade:
     def _calculate_current_beta(self) -> float:
         return self.get_beta_at_phase(-1)
 
-    def merge_files(self, file_idxs: list[int]) -> list[int]:
-        sequences = [self._files[i].pop(0) for i in file_idxs]
-        
-        out = []
-
-        while not any([len(x) == 0 for x in sequences]):
-            current_elements: list[int] = [sequences[i][0] for i in range(len(sequences)) if len(sequences[i]) > 0]
-            if len(current_elements) == 0:
-                break
-            
-            min_element     = min(current_elements)
-            min_element_idx = current_elements.index(min_element)
+    def _num_runs(self, i: int) -> int:
+        """
+        Runs of the file `i`, dummy ones included.
+        """
+        return len(self._files[i]) + self._dummy_runs[i]
 
-            out.append(current_elements[min_element_idx])
-            if min_element == float('inf'):
-                break
+    def _empty_file_idx(self) -> int:
+        return next(i for i in range(self.max_open_files) if self._num_runs(i) == 0)
 
-            sequences[min_element_idx].pop(0) # min element
-            if len(sequences[min_element_idx]) == 0:
-                sequences.pop(min_element_idx)
-        return out
+    def merge_files(self, file_idxs: list[int]) -> Optional[list[int]]:
+        """
+        Merges the first run of each file of `file_idxs`. The dummy runs
+        come after the real ones, so they are only taken from the files
+        without real runs left: the merge is (k-d)-way, a plain copy of a
+        single real run, or None (a new dummy run) if every run was a dummy.
+        """
+        sequences = []
+        for i in file_idxs:
+            if len(self._files[i]) > 0:
+                sequences.append(self._files[i].pop(0))
+            else:
+                self._dummy_runs[i] -= 1
+        if not sequences:
+            return None
+        self.stats.merged(len(s) for s in sequences)
+        if len(sequences) == 1:
+            merged = iter(sequences[0])
+        else:
+            merged = merge_runs(sequences, key=self._merge_key)
+        # On disk the merged run is streamed straight to the output tape
+        return merged if self._on_disk else list(merged)
 
     def sort(self) -> float:
         """
         Apply the algorithm to the specified registers.
         Returns the average load `alpha`.
         """
-        out_idx = self._files.index([])
-        while sum(len(x) for x in self._files) > 1:
+        out_idx = self._empty_file_idx()
+        while sum(map(self._num_runs, range(self.max_open_files))) > 1:
+            self.observer.phase_start(self, self._fase)
             files_to_be_merged = list(range(self.max_open_files))
             files_to_be_merged.pop(out_idx)
             for _ in range(self.max_open_files-2):
                 if self._debug:
                     print("-----------------------")
                     print(f"[!] Current Merge: {[i+1 for i in files_to_be_merged]} -> {out_idx+1}")
-                    self._print_fase()
-
+                    PhasePrinter().phase_end(self, self._fase, self._calculate_current_beta())
+                    print("n_total_seqs:", sum(len(x) for f in self._files for x in f), "n_dummy_seqs:", sum(self._dummy_runs))
+                    self.stats.exclude()
+
+                # Each merge takes one run from every input file, so the step
+                # ends when the shortest one is empty.
+                n_merges = min(map(self._num_runs, files_to_be_merged))
+                out_file = self._files[out_idx]
                 write_ops = 0
-                while not any([len(self._files[idx]) == 0 for idx in files_to_be_merged]):
+                for _ in range(n_merges):
                     merged = self.merge_files(files_to_be_merged)
-                    self._files[out_idx].append(merged)
-                    write_ops += len(merged)
+                    if merged is None:
+                        # the real runs are merged first, so the dummy ones stay last
+                        self._dummy_runs[out_idx] += 1
+                        continue
+                    written = out_file.append(merged)
+                    self.observer.merge_done(self, self._fase, out_idx, written)
+                    write_ops += written
                 self.write_ops_per_phase.append(write_ops)
+                self.stats.end_phase()
 
-                if len(self._files[out_idx][0]) >= len(self.registers):
-                    if len(self._files[out_idx][0]) > len(self.registers): # Removes dummy runs
-                        self._files[out_idx][0] = self._files[out_idx][0][:len(self.registers)]
-
-                    self._print_fase()
+                if len(out_file) > 0 and len(out_file[0]) >= self._num_registers:
+                    self._end_fase()
                     alpha = self._calculate_alpha()
-                    if self.verbose: print(f"final {alpha:.2f}")
+                    self.observer.sort_end(self, alpha)
 
                     return alpha
                 
-                out_idx = self._files.index([])
+                out_idx = self._empty_file_idx()
                 files_to_be_merged.remove(out_idx)
-            self._print_fase()
+            self._end_fase()
 
         alpha = self._calculate_alpha()
-        if self.verbose: print(f"final {alpha:.2f}")
+        self.observer.sort_end(self, alpha)
         return alpha
 
+    @staticmethod
+    def simulate(run_lengths: List[int], main_memory_size: int, max_open_files: int) -> SortSimulation:
+        """
+        Same phases as `sort()` over runs of `run_lengths` registers, from
+        the run lengths alone: O(runs x phases), no register is read.
+        """
+        k = max_open_files
+        files: List[Deque[int]] = [deque() for _ in range(k)]
+        dummy_runs: List[int] = [0] * k
+        num_registers = sum(run_lengths)
+
+        def num_runs(i: int) -> int:
+            return len(files[i]) + dummy_runs[i]
+
+        # `_distribute_registers_in_files`
+        tam_inicial_ideal = Cascade._get_ideal_initial_seq_sizes(len(run_lengths), k)
+        file_idx = 0
+        for length in run_lengths:
+            while tam_inicial_ideal[file_idx % k] == 0 or len(files[file_idx % k]) >= tam_inicial_ideal[file_idx % k]:
+                file_idx += 1
+            files[file_idx % k].append(length)
+            file_idx += 1
+        for i in range(k):
+            if tam_inicial_ideal[i] != 0:
+                dummy_runs[i] = tam_inicial_ideal[i] - len(files[i])
+
+        write_ops_per_phase = [0]
+        betas: List[float] = []
+        writes_per_phase: List[int] = []
+
+        def end_fase():
+            betas.append(beta(main_memory_size, sum(len(x) for x in files), write_ops_per_phase[-1]))
+
+        def alpha() -> float:
+            return (sum(write_ops_per_phase) / num_registers) if num_registers != 0 else .0
+
+        end_fase()
+
+        # `sort`
+        out_idx = next(i for i in range(k) if num_runs(i) == 0)
+        while sum(map(num_runs, range(k))) > 1:
+            files_to_be_merged = list(range(k))
+            files_to_be_merged.pop(out_idx)
+            writes_per_phase.append(0)
+            for _ in range(k - 2):
+                n_merges = min(map(num_runs, files_to_be_merged))
+                write_ops = 0
+                for _ in range(n_merges):
+                    # `merge_files`
+                    length = 0
+                    is_dummy = True
+                    for i in files_to_be_merged:
+                        if files[i]:
+                            length += files[i].popleft()
+                            is_dummy = False
+                        else:
+                            dummy_runs[i] -= 1
+                    if is_dummy:
+                        dummy_runs[out_idx] += 1
+                        continue
+                    files[out_idx].append(length)
+                    write_ops += length
+                write_ops_per_phase.append(write_ops)
+                writes_per_phase[-1] += write_ops
+
+                if files[out_idx] and files[out_idx][0] >= num_registers:
+                    end_fase()
+                    return SortSimulation(alpha(), betas, writes_per_phase)
+
+                out_idx = next(i for i in range(k) if num_runs(i) == 0)
+                files_to_be_merged.remove(out_idx)
+            end_fase()
+
+        return SortSimulation(alpha(), betas, writes_per_phase)
+
+    @property
+    def io_per_phase(self) -> List[IOCounters]:
+        """
+        Blocks and bytes read/written on each entry of `write_ops_per_phase`.
+        """
+        return [phase.io for phase in self.stats.phases]
+
+    @property
+    def seconds_per_phase(self) -> List[float]:
+        return [phase.seconds for phase in self.stats.phases]
+
+    def io_report(self) -> str:
+        """
+        Stats of each phase, with the wall time split between stalled on I/O and merging.
+        """
+        return self.stats.report()
+
+    def close(self) -> None:
+        """
+        Removes the tapes (and their scratch directory) used by the sort.
+        """
+        close_tapes(self._files)
+
 if __name__ == "__main__":
     import random
     import argparse
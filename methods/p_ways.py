@@ -1,40 +1,91 @@
-from typing import List, Set, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from array import array
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
 
 import sys
 sys.path.append('..')
 
-from utils.heap import Heap
+from utils.heap import RUN_FORMATIONS
 from utils.utils import beta
+from utils.tape import BLOCK_RECORDS, IOCounters, TapeRun, make_tapes, close_tapes, read_tape_run
+from utils.stats import SortSimulation, SortStats
+from utils.events import PhasePrinter, SortObserver
+from utils.merge import merge_runs
+from utils.planner import MergePlan, MergeStep, plan_merges
+from utils.runfile import RECORD_TYPE
+from utils.records import KeyExtractor, RecordLayout, record_key, record_str
 import math
 import os
 
+def _merge_packed_runs(sequences: List[array]) -> array:
+    # runs on a worker process: the sequences travel packed as int64 arrays
+    return array(RECORD_TYPE, merge_runs(sequences))
+
+def _merge_tape_runs(locations: List[Tuple[str, int, int, int]]) -> array:
+    # same, but the sequences are read from the tape files by the worker itself
+    return array(RECORD_TYPE, merge_runs([read_tape_run(*location) for location in locations]))
+
+def _merge_record_runs(sequences: List[List]) -> List:
+    # same, for key/payload records: they travel as lists of tuples and only the keys are compared
+    return list(merge_runs(sequences, key=record_key))
+
 class PWays:
 
     def __init__(self, main_memory_size: int, 
-                 num_sorted_sequences: int, max_open_files: int, registers: List[int] = [],
+                 num_sorted_sequences: int, max_open_files: int, registers: Iterable[int] = [],
                  sorted_sequences: List[List[int]] = [],
-                 save_results: bool = False, is_inputing_sorted_sequences: bool = True) -> None:
+                 save_results: bool = False, is_inputing_sorted_sequences: bool = True,
+                 tape_dir: Optional[str] = None, block_size: int = BLOCK_RECORDS,
+                 workers: int = 1, io_depth: int = 0,
+                 verbose: bool = True, observer: Optional[SortObserver] = None,
+                 run_formation: str = "heap", optimal_merge: bool = False,
+                 key: Optional[KeyExtractor] = None, layout: Optional[RecordLayout] = None,
+                 counted: bool = False, compress: bool = False) -> None:
 
         self._main_memory_size: int = main_memory_size
+        # progress of the sort, printed in the "fase N beta" notation unless another observer is given
+        self.observer: SortObserver = observer if observer is not None else (PhasePrinter() if verbose else SortObserver())
+        # merges of the same phase are independent, with `workers` > 1 they run on a process pool
+        self._workers: int = workers
+        # how the sorted sequences are generated from `registers` (see `utils.heap.RUN_FORMATIONS`)
+        self._run_formation = RUN_FORMATIONS[run_formation]
+        # merge the sequences following a minimum total write plan (`utils.planner`) instead of in phases over the files
+        self._optimal_merge: bool = optimal_merge
+        self.plan: Optional[MergePlan] = None
 
         self._num_sorted_sequences: int = num_sorted_sequences
         self._max_open_files: int = max_open_files
-        self._files: List[List[List[int]]] = [[] for _ in range(max_open_files)]
+        # with a key extractor (for the registers) or a layout (for the sorted sequences) the records are key/payload pairs, merged by key
+        self._key: Optional[KeyExtractor] = key
+        self._records: bool = key is not None or layout is not None
+        # with `counted` the sequences are (value, count) entries (`utils.tape.CountedRun`), merged by value
+        self._counted: bool = counted
+        self._merge_key = record_key if self._records or counted else None
+        # files live on disk (one tape per file under `tape_dir`, delta + varint encoded with `compress`) or in main memory if `tape_dir` is None
+        self._on_disk: bool = tape_dir is not None
+        self._files = make_tapes(max_open_files, tape_dir, block_size, io_depth, (layout or RecordLayout()) if self._records else None, counted, compress)
+        # comparisons, records, runs, I/O and time of the run generation and of each phase
+        self.stats = SortStats(self._files)
 
         self._num_input_files: int = math.ceil(max_open_files / 2)
         self._index_input_files: Set[int] = set()
 
         self._num_output_files: int = math.floor(max_open_files / 2)
 
+        self.observer.phase_start(self, 0)
         # this class can receive the registers list or the heap result (sorted sequences)
         if is_inputing_sorted_sequences:
             self._populate_files(sorted_sequences)
             self._num_registers = self._get_num_registers(sorted_sequences)
         else:
-            self._registers: List[int] = registers
+            # `registers` may be any iterable, it is only read once by the heap
+            self._registers: Iterable[int] = registers
             self._r = self._get_sorted_sequences()
-            self._num_registers: int = len(registers)
-        
+            self._num_registers: int = sum(len(sequence) for file in self._files for sequence in file)
+
+        self.stats.num_registers = self._num_registers
+        self.stats.distributed(sum(len(file) for file in self._files), sum(len(sequence) for file in self._files for sequence in file))
 
         self._result_path = "results"
         self._save: bool = save_results
@@ -47,12 +98,23 @@ class PWays:
         return num_registers
 
     def _get_sorted_sequences(self) -> None:
-        heap = Heap(self._main_memory_size, self._registers)
-        sorted_sequences = heap.sort()
-        if len(sorted_sequences) != self._num_sorted_sequences:
-            raise ValueError(f"The number of sorted sequences is different from the expected {self._num_sorted_sequences}, got {len(sorted_sequences)}")
+        heap = self._run_formation(self._main_memory_size, self._registers, stats=self.stats, key=self._key)
+        if self._on_disk:
+            # the runs are streamed straight to the input tapes, as `_populate_files` would place them
+            num_sorted_sequences: int = heap.write_runs(self._files[:self._num_input_files])
+            self._index_input_files.update(i for i in range(self._num_input_files) if self._files[i])
+            for index in range(self._num_input_files):
+                for sequence in self._files[index]:
+                    self.observer.run_written(self, 0, index, len(sequence))
+        else:
+            sorted_sequences = heap.sort()
+            num_sorted_sequences = len(sorted_sequences)
+
+        if num_sorted_sequences != self._num_sorted_sequences:
+            raise ValueError(f"The number of sorted sequences is different from the expected {self._num_sorted_sequences}, got {num_sorted_sequences}")
         
-        self._populate_files(sorted_sequences)
+        if not self._on_disk:
+            self._populate_files(sorted_sequences)
     
         """i = 0
         for file in self._files:
@@ -67,24 +129,80 @@ class PWays:
     def _populate_files(self, sorted_sequences) -> None:
         for i in range(self._num_sorted_sequences):
             file_index: int = i % self._num_input_files
-            self._files[file_index].append(sorted_sequences[i])
+            length: int = self._files[file_index].append(sorted_sequences[i])
+            self.observer.run_written(self, 0, file_index, length)
             self._index_input_files.add(file_index)
 
-    def _f_print(self, phase: int, beta_value: float) -> None:
-        print(f"fase {phase} {beta_value:.2f}")
-        for index, file in enumerate(self._files):
-            if file:
-                print(f"{index + 1}:", end=" ")
-                for sequence in file:
-                    print("{", end="")
-                    for i in range(len(sequence)):
-                        print(sequence[i], end=" " if i != len(sequence)-1 else "")
-                    print("}", end="")
-                print()
+    def format_file(self, index: int, file) -> str:
+        # the sequences of a file, as printed at the end of each phase
+        return f"{index + 1}: " + "".join("{" + " ".join(map(record_str, sequence)) + "}" for sequence in file)
+
+    def _phase_groups(self, max_input_index: int) -> Iterator[Tuple[int, List]]:
+        # yields the sequences merged by each step of the phase and the index of the file receiving the result
+        counter: int = 0
+        mod_value: int = self._max_open_files - self._num_input_files
+        while len(self._index_input_files) != 0:
+            sequences_to_merge = []
+
+            # get the first sequence of each input file
+            for index in list(self._index_input_files):
+                file = self._files[index]
+                if file:
+                    sequence = file.pop(0)
+                    sequences_to_merge.append(sequence)
+
+                    if not file:
+                        self._index_input_files.remove(index)
+            self.stats.merged(len(sequence) for sequence in sequences_to_merge)
+
+            # get the index of the output file that will receive the merged sequence
+            r_file_index: int = (max_input_index + ((counter % mod_value) + 1)) % self._max_open_files
+            counter += 1
+
+            yield r_file_index, sequences_to_merge
+
+    def _merge_groups(self, groups: Iterator[Tuple[int, List]], pool: Optional[Executor]) -> Iterator[Tuple[int, Iterable[int]]]:
+        if pool is None:
+            # merge the sequences in a single pass (streamed from the input tapes when on disk)
+            for r_file_index, sequences_to_merge in groups:
+                yield r_file_index, merge_runs(sequences_to_merge, key=self._merge_key)
+            return
+
+        # the merges are sent to the workers, the results come back in order so each file keeps its sequences in place
+        pending = deque()
+        for r_file_index, sequences_to_merge in groups:
+            if self._records or self._counted:
+                future = pool.submit(_merge_record_runs, [list(sequence) for sequence in sequences_to_merge])
+            else:
+                # the files are all tapes of the same kind: either every sequence is located or none is
+                locations = [sequence.locate() if isinstance(sequence, TapeRun) else None for sequence in sequences_to_merge]
+                if all(locations):
+                    # on disk only the offsets travel: each worker reads its own sequences
+                    future = pool.submit(_merge_tape_runs, locations)
+                else:
+                    future = pool.submit(_merge_packed_runs, [array(RECORD_TYPE, sequence) for sequence in sequences_to_merge])
+            # the popped sequences are kept until merged, so their tapes are not rewound under the workers
+            pending.append((r_file_index, future, sequences_to_merge))
+            # at most two merges per worker are kept in main memory
+            if len(pending) >= 2 * self._workers:
+                r_file_index, future, _ = pending.popleft()
+                yield r_file_index, future.result()
+        for r_file_index, future, _ in pending:
+            yield r_file_index, future.result()
 
     def sort(self) -> float:
+        pool: Optional[Executor] = ProcessPoolExecutor(self._workers) if self._workers > 1 else None
+        try:
+            return self._sort(pool)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def _sort(self, pool: Optional[Executor]) -> float:
+        if self._optimal_merge:
+            return self._sort_planned(pool)
+
         phase: int = 0
-        total_write_operations: int = 0
         while True:
             if phase == 0:
                 beta_value:float = beta(self._main_memory_size, self._num_sorted_sequences, self._num_registers, depth=0)
@@ -97,46 +215,30 @@ class PWays:
                         # adding the size of all the genererated sequences
                         sum_size_of_generated_sequences += len(sequence)
 
-                total_write_operations += sum_size_of_generated_sequences
                 beta_value:float = beta(self._main_memory_size, num_sequences, sum_size_of_generated_sequences, depth=0)
             
-            self._f_print(phase, beta_value)
+            self.stats.end_phase()
+            self.observer.phase_end(self, phase, beta_value)
+            # reading the files to print them is not part of the sort
+            self.stats.exclude()
             phase += 1
 
-            if len(self._index_input_files) <= 1 and len(self._files[list(self._index_input_files)[0]]) <= 1:
+            # done once a single sequence is left (or none, on an empty input)
+            if len(self._index_input_files) <= 1 and all(len(self._files[i]) <= 1 for i in self._index_input_files):
                 break
+            self.observer.phase_start(self, phase)
 
             # max input index before start the current phase
             max_input_index: int = max(self._index_input_files)
 
-            counter: int = 0
-
             # accumulator of index input files for the next phase
             accumulator_index_input_files: Set[int] = set()
 
-            while len(self._index_input_files) != 0:
-                sequences_to_merge: List[List[int]] = []
-
-                # get the first sequence of each input file
-                for index in list(self._index_input_files):
-                    file = self._files[index]
-                    if file:
-                        sequence: List[int] = file.pop(0)
-                        sequences_to_merge.append(sequence)
-
-                        if not file:
-                            self._index_input_files.remove(index)
-
-                # merge the sequences
-                merged_sequence: List[int] = PWays.merge_p_lists(sequences_to_merge)
-
-                # get the index of the output file that will receive the merged sequence
-                mod_value: int = self._max_open_files - self._num_input_files
-                r_file_index: int = (max_input_index + ((counter % mod_value) + 1)) % self._max_open_files
-                counter += 1
-
+            groups = self._phase_groups(max_input_index)
+            for r_file_index, merged_sequence in self._merge_groups(groups, pool):
                 # append the merged sequence to the output file
-                self._files[r_file_index].append(merged_sequence)
+                length: int = self._files[r_file_index].append(merged_sequence)
+                self.observer.merge_done(self, phase, r_file_index, length)
 
                 # add the index of the output file to the accumulator
                 accumulator_index_input_files.add(r_file_index)
@@ -146,15 +248,92 @@ class PWays:
             self._num_input_files = len(self._index_input_files)
             self._num_output_files = self._max_open_files - self._num_input_files
         
-        #Wrong?!
-        alpha: float = total_write_operations / self._num_registers
-        print(f"final {alpha:.2f}")
+        # registers written by the merges over the number of registers
+        alpha: float = self.stats.alpha
+        self.observer.sort_end(self, alpha)
 
         # save the results
         if self._save:
             self._save_results(alpha)
 
         return alpha
+
+    def _plan_groups(self, steps: List[MergeStep], run_ids: List[List[int]], location: Dict[int, int]) -> Iterator[Tuple[int, List]]:
+        # yields the sequences merged by each step of the plan and the index of the file receiving the result
+        for step in steps:
+            sequences_to_merge = []
+            input_files: Set[int] = set()
+            for run_id in step.inputs:
+                if self.plan.is_dummy(run_id):
+                    continue
+                index = location.pop(run_id)
+                position = run_ids[index].index(run_id)
+                del run_ids[index][position]
+                sequences_to_merge.append(self._files[index].pop(position))
+                input_files.add(index)
+            self.stats.merged(len(sequence) for sequence in sequences_to_merge)
+
+            # the fan-in is at most `max_open_files - 1`, so some file holds none of the inputs: the emptiest one gets the result
+            r_file_index: int = min((index for index in range(self._max_open_files) if index not in input_files), key=lambda index: len(run_ids[index]))
+            run_ids[r_file_index].append(step.output)
+            location[step.output] = r_file_index
+
+            yield r_file_index, sequences_to_merge
+
+    def _end_planned_phase(self, phase: int) -> None:
+        num_sequences: int = sum(len(file) for file in self._files)
+        beta_value: float = beta(self._main_memory_size, num_sequences, self._num_registers, depth=0) if num_sequences else 0.0
+        self.stats.end_phase()
+        self.observer.phase_end(self, phase, beta_value)
+        # reading the files to print them is not part of the sort
+        self.stats.exclude()
+
+    def _sort_planned(self, pool: Optional[Executor]) -> float:
+        # the sequences get ids in file order, the plan merges the shortest ones first
+        run_ids: List[List[int]] = []
+        lengths: List[int] = []
+        for file in self._files:
+            run_ids.append(list(range(len(lengths), len(lengths) + len(file))))
+            lengths.extend(len(sequence) for sequence in file)
+        location: Dict[int, int] = {run_id: index for index, ids in enumerate(run_ids) for run_id in ids}
+
+        self.plan = plan_merges(lengths, self._max_open_files)
+        self.stats.predicted_alpha = self.plan.alpha
+        self._end_planned_phase(0)
+
+        # every level of the plan is a phase: its merges only read sequences written by the previous ones
+        for phase, steps in enumerate(self.plan.levels(), start=1):
+            self.observer.phase_start(self, phase)
+            groups = self._plan_groups(steps, run_ids, location)
+            for r_file_index, merged_sequence in self._merge_groups(groups, pool):
+                length: int = self._files[r_file_index].append(merged_sequence)
+                self.observer.merge_done(self, phase, r_file_index, length)
+            self._end_planned_phase(phase)
+
+        alpha: float = self.stats.alpha
+        self.observer.sort_end(self, alpha)
+
+        if self._save:
+            self._save_results(alpha)
+
+        return alpha
+
+    @property
+    def io_per_phase(self) -> List[IOCounters]:
+        # blocks and bytes read/written on each phase (phase 0 is the distribution of the sorted sequences)
+        return [phase.io for phase in self.stats.phases]
+
+    @property
+    def seconds_per_phase(self) -> List[float]:
+        return [phase.seconds for phase in self.stats.phases]
+
+    def io_report(self) -> str:
+        # stats of each phase, with the wall time split between stalled on I/O and merging
+        return self.stats.report()
+
+    def close(self) -> None:
+        # removes the tapes (and their scratch directory) used by the sort
+        close_tapes(self._files)
     
     def _save_results(self, alpha: float) -> None:
         if not os.path.exists(self._result_path):
@@ -164,6 +343,71 @@ class PWays:
         with open(path, "a") as f:
             f.write(f"{self._r} {alpha}\n")
 
+    @staticmethod
+    def simulate(run_lengths: List[int], main_memory_size: int, max_open_files: int, optimal_merge: bool = False) -> SortSimulation:
+        # same phases as `sort()` over sequences of `run_lengths` registers, in O(runs x phases) without reading a register
+        num_registers: int = sum(run_lengths)
+        if optimal_merge:
+            plan: MergePlan = plan_merges(run_lengths, max_open_files)
+            num_sequences: int = len(run_lengths)
+            betas: List[float] = [beta(main_memory_size, num_sequences, num_registers, depth=0) if num_sequences else 0.0]
+            writes_per_phase: List[int] = []
+            for steps in plan.levels():
+                for step in steps:
+                    num_sequences -= sum(not plan.is_dummy(run_id) for run_id in step.inputs) - 1
+                writes_per_phase.append(sum(step.length for step in steps))
+                betas.append(beta(main_memory_size, num_sequences, num_registers, depth=0) if num_sequences else 0.0)
+            return SortSimulation(sum(writes_per_phase) / num_registers if num_registers else 0.0, betas, writes_per_phase)
+
+        # `_populate_files`: round-robin over the input files
+        num_input_files: int = math.ceil(max_open_files / 2)
+        files: List[deque] = [deque() for _ in range(max_open_files)]
+        index_input_files: Set[int] = set()
+        for i, length in enumerate(run_lengths):
+            files[i % num_input_files].append(length)
+            index_input_files.add(i % num_input_files)
+
+        betas = []
+        writes_per_phase = []
+        phase: int = 0
+        while True:
+            if phase == 0:
+                betas.append(beta(main_memory_size, len(run_lengths), num_registers, depth=0))
+            else:
+                num_sequences = sum(len(files[index]) for index in index_input_files)
+                betas.append(beta(main_memory_size, num_sequences, sum(sum(files[index]) for index in index_input_files), depth=0))
+            phase += 1
+
+            # same end as `_sort`: a single sequence is left, or none on an empty input
+            if len(index_input_files) <= 1 and all(len(files[index]) <= 1 for index in index_input_files):
+                break
+
+            # `_phase_groups`: the same set operations, so the files are visited in the same order
+            max_input_index: int = max(index_input_files)
+            mod_value: int = max_open_files - num_input_files
+            accumulator_index_input_files: Set[int] = set()
+            counter: int = 0
+            written: int = 0
+            while len(index_input_files) != 0:
+                length = 0
+                for index in list(index_input_files):
+                    file = files[index]
+                    if file:
+                        length += file.popleft()
+                        if not file:
+                            index_input_files.remove(index)
+                r_file_index: int = (max_input_index + ((counter % mod_value) + 1)) % max_open_files
+                counter += 1
+                files[r_file_index].append(length)
+                accumulator_index_input_files.add(r_file_index)
+                written += length
+            writes_per_phase.append(written)
+
+            index_input_files = accumulator_index_input_files
+            num_input_files = len(index_input_files)
+
+        return SortSimulation(sum(writes_per_phase) / num_registers if num_registers else 0.0, betas, writes_per_phase)
+
     @staticmethod
     def merge_p_lists(lists_to_merge: List[List[int]]) -> List[int]:
         if not lists_to_merge:
@@ -171,11 +415,7 @@ class PWays:
         if len(lists_to_merge) == 1:
             return lists_to_merge[0]
 
-        center: int = len(lists_to_merge) // 2
-        left: List[int] = PWays.merge_p_lists(lists_to_merge[:center])
-        right: List[int] = PWays.merge_p_lists(lists_to_merge[center:])
-
-        return PWays.merge_2_lists(left, right)
+        return list(merge_runs(lists_to_merge))
 
     @staticmethod
     def merge_2_lists(left: List[int], right: List[int]) -> List[int]:
@@ -211,3 +451,21 @@ if __name__ == "__main__":
 
     p_ways = PWays(main_memory_size, num_sorted_sequences, max_open_files, sorted_sequences=sorted_sequences, save_results=False, is_inputing_sorted_sequences=True)
     p_ways.sort()
+
+    # The merges on a process pool read their sequences from the tape files: with blocks smaller than
+    # the file buffer they must still see every record, so the result is the one of the sort in memory
+    import random
+    import tempfile
+
+    registers = [random.randint(0, 1_000_000) for _ in range(20_000)]
+    num_sorted_sequences = len(RUN_FORMATIONS["heap"](main_memory_size, registers).sort())
+    for optimal_merge in (False, True):
+        results = []
+        for tape_dir, workers in ((None, 1), (tempfile.mkdtemp(), 2)):
+            p_ways = PWays(main_memory_size, num_sorted_sequences, max_open_files, registers=registers, is_inputing_sorted_sequences=False,
+                           tape_dir=tape_dir, block_size=7, workers=workers, verbose=False, optimal_merge=optimal_merge)
+            alpha = p_ways.sort()
+            results.append(([list(sequence) for file in p_ways._files for sequence in file], alpha))
+            p_ways.close()
+        assert results[0] == results[1] and results[0][0] == [sorted(registers)]
+        print(f"optimal_merge={optimal_merge}: 2 workers on disk match the sort in memory (alpha {results[0][1]:.2f})")
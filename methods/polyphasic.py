@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import heapq
+from collections import deque
 from math import inf
 import sys
 sys.path.append('..')
@@ -7,23 +8,59 @@ sys.path.append('..')
 from typing import *
 import random
 import matplotlib.pyplot as plt
-from utils.heap import Heap
+from utils.heap import RUN_FORMATIONS
+from utils.utils import beta
+from utils.tape import BLOCK_RECORDS, make_tapes, close_tapes
+from utils.stats import SortSimulation, SortStats
+from utils.events import PhasePrinter, SortObserver
+from utils.merge import merge_runs
+from utils.records import KeyExtractor, RecordLayout, record_key, record_str
 
 #from utils import *
 
 class Polyphasic:
     def __init__(
         self,
-        registers: List[int],
+        registers: Iterable[int],
         main_memory_size: int,
         num_sorted_sequences: int,
         max_open_files: int,
+        tape_dir: Optional[str] = None,
+        block_size: int = BLOCK_RECORDS,
+        io_depth: int = 0,
+        observer: Optional[SortObserver] = None,
+        run_formation: str = "heap",
+        key: Optional[KeyExtractor] = None,
+        layout: Optional[RecordLayout] = None,
+        counted: bool = False,
+        compress: bool = False,
     ) -> None:
         self.max_open_files = max_open_files
         self.main_memory_size = main_memory_size
         self.num_sorted_size = num_sorted_sequences
         self.registers = registers
         self.write_ops_per_phase = []
+        # Progress of the sort. Without an observer, `sort(verbose=True)` prints it in the "fase N beta" notation
+        self.observer = observer
+        # How the sorted sequences are generated from `registers` (see `utils.heap.RUN_FORMATIONS`)
+        self._run_formation = RUN_FORMATIONS[run_formation]
+        self._observer: SortObserver = SortObserver()
+
+        # `max_open_files - 1` input tapes and one output tape, kept under
+        # `tape_dir` (delta + varint encoded with `compress`) or in main
+        # memory if `tape_dir` is None.
+        self._on_disk = tape_dir is not None
+        # With a key extractor (for the registers) or a layout (for the runs given to `sort`)
+        # the records are key/payload pairs, merged by key
+        self._key = key
+        self._records = key is not None or layout is not None
+        # With `counted` the runs are (value, count) entries (`utils.tape.CountedRun`), merged by value
+        self._merge_key = record_key if self._records or counted else None
+        self._files = make_tapes(max_open_files, tape_dir, block_size, io_depth, (layout or RecordLayout()) if self._records else None, counted, compress)
+        # Comparisons, records, runs, I/O and time of the run generation and of each phase
+        self.stats = SortStats(self._files)
+        self._dummies = [0] * max_open_files
+        self._num_registers = 0
 
 
 
@@ -61,60 +98,226 @@ class Polyphasic:
     #     print(f"final {alpha:.2f}")
     #     return seqs, betas, alpha
 
-    def polyphase_merge_sort(self,data, verbose=False):
-        initial_runs = data
-        #if verbose: print(f"Initial runs: {initial_runs}")
-        k = self.max_open_files
-        runs = [initial_runs]
-        total_write_ops = 0
-        total_records = sum(len(run) for run in initial_runs)
-
-        while len(runs[-1]) > 1:
-            new_run = []
-            for i in range(0, len(runs[-1]), k):
-                merge_runs = []
-                for j in range(k):
-                    if i + j < len(runs[-1]):
-                        merge_runs.extend(runs[-1][i + j])
-                merge_runs.sort()
-                new_run.append(merge_runs)
-                total_write_ops += len(merge_runs)
-            runs.append(new_run)
-            #if verbose: print(runs)
-
-        alpha = total_write_ops / total_records if total_records != 0 else 0
-        return runs, alpha
-
-    def calculate_alpha(self,runs):
-        alpha = (sum(self.write_ops_per_phase) / len(self.registers)) if len(self.registers) != 0 else 0
+    def _distribute(self, data) -> None:
+        """
+        Distributes the initial runs over the `max_open_files - 1` input tapes
+        following the generalized Fibonacci numbers (Knuth's Algorithm D).
+        Runs are written as they come, level by level, so their number does
+        not need to be known in advance. Whatever a tape lacks to reach the
+        current perfect distribution is kept as a count of dummy runs.
+        """
+        p = self.max_open_files - 1
+        ideal = [1] * p + [0]
+        self._dummies = [1] * p + [0]
+        self._num_registers = 0
+
+        j = 0
+        for n_runs, run in enumerate(data):
+            if n_runs > 0:
+                if self._dummies[j] < self._dummies[j + 1]:
+                    j += 1
+                elif self._dummies[j] == 0:
+                    # Every tape reached the current level: go to the next one
+                    a = ideal[0]
+                    for i in range(p):
+                        self._dummies[i] = a + ideal[i + 1] - ideal[i]
+                        ideal[i] = a + ideal[i + 1]
+                    j = 0
+                else:
+                    j = 0
+            length = self._files[j].append(run)
+            self._observer.run_written(self, 0, j, length)
+            self._num_registers += length
+            self._dummies[j] -= 1
+
+        if all(len(f) == 0 for f in self._files):
+            self._dummies = [0] * self.max_open_files
+
+    def _total_runs(self) -> int:
+        return sum(len(f) + d for f, d in zip(self._files, self._dummies))
+
+    def _sorted(self) -> bool:
+        """
+        A single run is left, or a single real run with dummy ones: merging
+        them would only copy it.
+        """
+        return self._total_runs() <= 1 or sum(len(f) for f in self._files) <= 1
+
+    def polyphase_merge_sort(self, data, verbose=False):
+        """
+        Merges the runs of `data` until a single one is left. Each phase
+        merges one run of every input tape into the output tape until one
+        input tape is empty, which becomes the output tape of the next phase.
+        Returns the tape holding the sorted registers.
+        """
+        if self.observer is not None:
+            self._observer = self.observer
+        else:
+            self._observer = PhasePrinter() if verbose else SortObserver()
+
+        self._observer.phase_start(self, 0)
+        self._distribute(data)
+        self.stats.num_registers = self._num_registers
+        self.stats.distributed(sum(len(f) for f in self._files), self._num_registers)
+        self.stats.end_phase()
+        betas = [self.calculate_beta()]
+        self._end_phase(0, betas[0])
+
+        out = self.max_open_files - 1
+        while not self._sorted():
+            self._observer.phase_start(self, len(betas))
+            inputs = [i for i in range(self.max_open_files) if i != out]
+            n_merges = min(len(self._files[i]) + self._dummies[i] for i in inputs)
+
+            write_ops = 0
+            for _ in range(n_merges):
+                # Dummy runs come first on every tape and are merged as empty runs
+                group = []
+                for i in inputs:
+                    if self._dummies[i] > 0:
+                        self._dummies[i] -= 1
+                    else:
+                        group.append(self._files[i].pop(0))
+
+                if group:
+                    self.stats.merged(len(run) for run in group)
+                    length = self._files[out].append(merge_runs(group, key=self._merge_key))
+                    self._observer.merge_done(self, len(betas), out, length)
+                    write_ops += length
+                else:
+                    self._dummies[out] += 1
+            self.write_ops_per_phase.append(write_ops)
+            self.stats.end_phase()
+
+            out = next(i for i in inputs if len(self._files[i]) + self._dummies[i] == 0)
+            betas.append(self.calculate_beta())
+            self._end_phase(len(betas) - 1, betas[-1])
+
+        return next((f for f in self._files if len(f) > 0), self._files[0]), betas
+
+    def calculate_alpha(self):
+        alpha = (sum(self.write_ops_per_phase) / self._num_registers) if self._num_registers != 0 else 0
         return alpha
 
-    def calculate_beta(self,runs, memory_size):
-        betas = []
-        for run in runs:
-            total_length = sum(len(seq) for seq in run)
-            avg_length = total_length / len(run)
-            beta = avg_length / memory_size
-            betas.append(beta)
-        return betas
+    def calculate_beta(self):
+        """
+        Average size of the (real) runs on the tapes, over the main memory size.
+        """
+        num_runs = sum(len(f) for f in self._files)
+        return beta(self.main_memory_size, num_runs, self._num_registers) if num_runs != 0 else 0
+
+    def format_file(self, i, f):
+        """
+        The runs of a tape, as printed at the end of each phase.
+        """
+        return f'{i + 1}: ' + ' '.join('{' + ' '.join(map(record_str, run)) + '}' for run in f)
+
+    def _end_phase(self, c, beta_value):
+        self._observer.phase_end(self, c, beta_value)
+        # Printing the tapes is not part of the sort
+        self.stats.exclude()
 
     def sort(self, data=None, verbose=True):
+        """
+        Returns the tape holding the sorted registers, the average load
+        `alpha` and the `beta` of every phase. The registers written on each
+        phase are kept in `write_ops_per_phase`.
+        """
         if data is None:
-            heap = Heap(self.main_memory_size, self.registers)
-            data = heap.sort()
-        runs, alpha = self.polyphase_merge_sort(data, verbose=verbose)
-        betas = self.calculate_beta(runs, self.main_memory_size)
-        if verbose:
-            for c in range(len(runs)):
-                print(f'fase {c} {betas[c]:.2f}')
-                for l in range(len(runs[c])):
-                    if c == len(runs) - 1 and l == len(runs[c]) - 1:
-                        print(f'{self.main_memory_size + 1}: {{{" ".join(map(str, runs[c][l]))}}}')
+            heap = self._run_formation(self.main_memory_size, self.registers, stats=self.stats, key=self._key)
+            # On disk the runs are streamed straight to the tapes
+            data = heap.iter_runs() if self._on_disk else heap.sort()
+        sorted_file, betas = self.polyphase_merge_sort(data, verbose=verbose)
+        alpha = self.calculate_alpha()
+        self._observer.sort_end(self, alpha)
+        return sorted_file, alpha, betas
+
+    @property
+    def io_per_phase(self):
+        """
+        Blocks and bytes read/written on each phase (phase 0 is the initial distribution).
+        """
+        return [phase.io for phase in self.stats.phases]
+
+    @property
+    def seconds_per_phase(self):
+        return [phase.seconds for phase in self.stats.phases]
+
+    def io_report(self):
+        """
+        Stats of each phase, with the wall time split between stalled on I/O and merging.
+        """
+        return self.stats.report()
+
+    def close(self):
+        """
+        Removes the tapes (and their scratch directory) used by the sort.
+        """
+        close_tapes(self._files)
+
+    @staticmethod
+    def simulate(run_lengths, main_memory_size, max_open_files):
+        """
+        Same phases as `sort()` over runs of `run_lengths` registers, from
+        the run lengths alone: O(runs x phases), no register is read.
+        """
+        files = [deque() for _ in range(max_open_files)]
+        num_registers = sum(run_lengths)
+
+        # `_distribute`
+        p = max_open_files - 1
+        ideal = [1] * p + [0]
+        dummies = [1] * p + [0]
+        j = 0
+        for n_runs, length in enumerate(run_lengths):
+            if n_runs > 0:
+                if dummies[j] < dummies[j + 1]:
+                    j += 1
+                elif dummies[j] == 0:
+                    a = ideal[0]
+                    for i in range(p):
+                        dummies[i] = a + ideal[i + 1] - ideal[i]
+                        ideal[i] = a + ideal[i + 1]
+                    j = 0
+                else:
+                    j = 0
+            files[j].append(length)
+            dummies[j] -= 1
+        if not run_lengths:
+            dummies = [0] * max_open_files
+
+        def calculate_beta():
+            num_runs = sum(len(f) for f in files)
+            return beta(main_memory_size, num_runs, num_registers) if num_runs != 0 else 0
+
+        # `polyphase_merge_sort`
+        betas = [calculate_beta()]
+        write_ops_per_phase = []
+        out = max_open_files - 1
+        while sum(len(f) + d for f, d in zip(files, dummies)) > 1 and sum(map(len, files)) > 1:
+            inputs = [i for i in range(max_open_files) if i != out]
+            n_merges = min(len(files[i]) + dummies[i] for i in inputs)
+
+            write_ops = 0
+            for _ in range(n_merges):
+                length = None
+                for i in inputs:
+                    if dummies[i] > 0:
+                        dummies[i] -= 1
                     else:
-                        print(f'{l + 1}: {{{" ".join(map(str, runs[c][l]))}}}')
+                        length = (length or 0) + files[i].popleft()
+                if length is not None:
+                    files[out].append(length)
+                    write_ops += length
+                else:
+                    dummies[out] += 1
+            write_ops_per_phase.append(write_ops)
+
+            out = next(i for i in inputs if len(files[i]) + dummies[i] == 0)
+            betas.append(calculate_beta())
 
-            print(f'final {alpha:.2f}')
-        return runs, alpha, betas
+        alpha = (sum(write_ops_per_phase) / num_registers) if num_registers != 0 else 0
+        return SortSimulation(alpha, betas, write_ops_per_phase)
 
     @staticmethod
     def gerar_sequencias(r, tamanho_max):
@@ -0,0 +1,119 @@
+"""
+Delta + varint encoding of blocks of int64 registers.
+
+A run is sorted, so the gap between consecutive registers is small and
+non-negative: each register is stored as its difference from the previous
+one in the block (the first one from 0), zigzag-encoded and written as a
+LEB128 varint, 7 bits per byte with the high bit set on every byte but the
+last one. Gaps of up to 127 take a single byte instead of the 8 of an
+int64. Every block is encoded on its own, so a block can be decoded
+without the ones before it (see `utils.tape.CompressedTape`).
+
+Differences wrap around in 64 bits, and zigzag maps the negative ones to
+odd numbers, so any sequence of int64 round-trips (the flat value, count
+pairs of the counted runs included), just less compactly than a sorted
+one. With numpy a block is encoded and decoded with a handful of vector
+operations; without it, one register at a time.
+"""
+
+from typing import Sequence
+from array import array
+
+from utils.runfile import RECORD_TYPE
+
+try:
+    import numpy as np
+except ImportError:  # pure Python fallback
+    np = None
+
+# Bytes of the longest varint (a 64 bit zigzag difference)
+MAX_VARINT = 10
+_MASK = (1 << 64) - 1
+
+def encode_block(block: Sequence[int]) -> bytes:
+    """
+    The delta + varint encoding of the int64 registers of `block`.
+    """
+    if np is not None:
+        return _encode_numpy(np.asarray(block, dtype=np.int64))
+
+    encoded = bytearray()
+    previous = 0
+    for x in block:
+        delta = (x - previous) & _MASK
+        previous = x
+        # zigzag: 0, -1, 1, -2... are 0, 1, 2, 3...
+        z = ((delta << 1) ^ (_MASK if delta >> 63 else 0)) & _MASK
+        while z >= 0x80:
+            encoded.append(z & 0x7F | 0x80)
+            z >>= 7
+        encoded.append(z)
+    return bytes(encoded)
+
+def decode_block(data: bytes, count: int) -> array:
+    """
+    The `count` registers encoded by `encode_block` in `data`.
+    """
+    if np is not None:
+        return _decode_numpy(data, count)
+
+    block = array(RECORD_TYPE)
+    previous = 0
+    z = shift = 0
+    for byte in data:
+        z |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            previous = (previous + ((z >> 1) ^ -(z & 1))) & _MASK
+            block.append(previous - (1 << 64) if previous >> 63 else previous)
+            z = shift = 0
+    if len(block) != count:
+        raise ValueError(f"A block of {count} registers decoded to {len(block)}")
+    return block
+
+def _encode_numpy(values) -> bytes:
+    with np.errstate(over="ignore"):
+        deltas = np.diff(values, prepend=np.int64(0))
+    zigzag = ((deltas << 1) ^ (deltas >> 63)).view(np.uint64)
+    # number of 7 bit groups of each varint
+    num_bytes = np.ones(len(zigzag), dtype=np.int64)
+    for i in range(1, MAX_VARINT):
+        num_bytes += zigzag >= np.uint64(1 << (7 * i))
+    width = int(num_bytes.max(initial=1))
+    shifts = np.arange(0, 7 * width, 7, dtype=np.uint64)
+    groups = ((zigzag[:, None] >> shifts) & np.uint64(0x7F)).astype(np.uint8)
+    positions = np.arange(width)
+    groups[positions < num_bytes[:, None] - 1] |= 0x80
+    # row by row: the groups of each varint, least significant first
+    return groups[positions < num_bytes[:, None]].tobytes()
+
+def _decode_numpy(data: bytes, count: int) -> array:
+    encoded = np.frombuffer(data, dtype=np.uint8)
+    last = encoded < 0x80
+    if int(last.sum()) != count:
+        raise ValueError(f"A block of {count} registers decoded to {int(last.sum())}")
+    starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    # position of each byte in its varint
+    positions = np.arange(len(encoded)) - np.repeat(starts, np.diff(np.append(starts, len(encoded))))
+    groups = (encoded & 0x7F).astype(np.uint64) << (positions.astype(np.uint64) * np.uint64(7))
+    zigzag = np.bitwise_or.reduceat(groups, starts) if count else groups
+    deltas = (zigzag >> np.uint64(1)).view(np.int64) ^ -(zigzag & np.uint64(1)).view(np.int64)
+    with np.errstate(over="ignore"):
+        values = np.cumsum(deltas, dtype=np.int64)
+    block = array(RECORD_TYPE)
+    block.frombytes(values.tobytes())
+    return block
+
+if __name__ == "__main__":
+    import random
+
+    blocks = [
+        sorted(random.randint(0, 10_000) for _ in range(1_000)),
+        [random.randint(-(1 << 63), (1 << 63) - 1) for _ in range(1_000)],
+        [-(1 << 63), (1 << 63) - 1, 0, -1, 1],
+        [],
+    ]
+    for block in blocks:
+        data = encode_block(block)
+        assert list(decode_block(data, len(block))) == block
+        print(f"{len(block)} registers: {len(data)} bytes ({8 * len(block) / max(1, len(data)):.2f}x)")
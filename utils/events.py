@@ -0,0 +1,92 @@
+"""
+Progress of a sort, reported as events instead of prints.
+
+Every method calls its observer with itself as `sorter`, which exposes the
+tapes as `files` (through `sorter._files`) and `format_file(index, file)`,
+the line printed for a file in the "fase N beta" notation.
+"""
+
+from typing import IO, Optional
+
+class SortObserver:
+    """
+    Receives the progress of a sort. Every handler does nothing, so
+    subclasses only override the events they need.
+    """
+    def phase_start(self, sorter, phase: int) -> None:
+        pass
+
+    def phase_end(self, sorter, phase: int, beta: float) -> None:
+        pass
+
+    def run_written(self, sorter, phase: int, file_index: int, length: int) -> None:
+        """
+        A run of `length` records was distributed to file `file_index`.
+        """
+        pass
+
+    def merge_done(self, sorter, phase: int, file_index: int, length: int) -> None:
+        """
+        A merged run of `length` records was written to file `file_index`.
+        """
+        pass
+
+    def sort_end(self, sorter, alpha: float) -> None:
+        pass
+
+class PhasePrinter(SortObserver):
+    """
+    Prints every phase in the "fase N beta" notation, with the full
+    contents of each file, then "final alpha".
+    """
+    def __init__(self, stream: Optional[IO[str]] = None) -> None:
+        # None prints to the current sys.stdout
+        self.stream: Optional[IO[str]] = stream
+
+    def phase_end(self, sorter, phase: int, beta: float) -> None:
+        print(f"fase {phase} {beta:.2f}", file=self.stream)
+        for index, file in enumerate(sorter._files):
+            if len(file) > 0:
+                print(sorter.format_file(index, file), file=self.stream)
+
+    def sort_end(self, sorter, alpha: float) -> None:
+        print(f"final {alpha:.2f}", file=self.stream)
+
+class SummaryPrinter(PhasePrinter):
+    """
+    Same phases as `PhasePrinter`, but each file is summed up by its number
+    of runs and their sizes, which never reads the records.
+    """
+    def phase_end(self, sorter, phase: int, beta: float) -> None:
+        print(f"fase {phase} {beta:.2f}", file=self.stream)
+        for index, file in enumerate(sorter._files):
+            if len(file) > 0:
+                sizes = [len(run) for run in file]
+                print(f"{index + 1}: {len(sizes)} runs, {sum(sizes)} records (min {min(sizes)}, max {max(sizes)})", file=self.stream)
+
+class ObserverGroup(SortObserver):
+    """
+    Forwards every event to several observers.
+    """
+    def __init__(self, *observers: SortObserver) -> None:
+        self.observers = observers
+
+    def phase_start(self, sorter, phase: int) -> None:
+        for observer in self.observers:
+            observer.phase_start(sorter, phase)
+
+    def phase_end(self, sorter, phase: int, beta: float) -> None:
+        for observer in self.observers:
+            observer.phase_end(sorter, phase, beta)
+
+    def run_written(self, sorter, phase: int, file_index: int, length: int) -> None:
+        for observer in self.observers:
+            observer.run_written(sorter, phase, file_index, length)
+
+    def merge_done(self, sorter, phase: int, file_index: int, length: int) -> None:
+        for observer in self.observers:
+            observer.merge_done(sorter, phase, file_index, length)
+
+    def sort_end(self, sorter, alpha: float) -> None:
+        for observer in self.observers:
+            observer.sort_end(sorter, alpha)
@@ -1,151 +1,629 @@
-from typing import List, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from array import array
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, count, groupby, islice
+from operator import itemgetter
+import bisect
+import heapq
+import math
+import os
+import time
 
-class Node:
-    def __init__(self, value: int) -> None:
-        self._value: int = value
-        self._is_marked: bool = False
+from utils.runfile import RECORD_TYPE, RunManifest, chunk_records, write_run_file
+from utils.records import KeyExtractor, record_key
+from utils.tape import CountedRun
 
-    @property
-    def value(self) -> int:
-        return self._value
+try:
+    import numpy as np
+except ImportError:  # `LoadSortStore` falls back to `sorted`
+    np = None
 
-    @property
-    def is_marked(self) -> bool:
-        return self._is_marked
+# Registers handed to each worker of `parallel_runs`
+PARALLEL_CHUNK = 1 << 20
+# Registers sorted per numpy call by `LoadSortStore`
+LOAD_SORT_BATCH = 1 << 16
+# Registers counted per `Counter` call by `CountingRuns`
+COUNT_BATCH = 1 << 12
+# `NaturalRuns`: records shifted by an insertion in the sorted list before it is a miss; misses
+# (net of the cheap insertions) before the list becomes a heap; written records compacted at
+# once; registers yielded per batch
+NATURAL_SHIFT = 64
+NATURAL_MISSES = 8
+NATURAL_COMPACT = 1 << 10
+NATURAL_BATCH = 1 << 10
 
-    def mark(self) -> None:
-        if not self._is_marked:
-            self._is_marked = True
-        else:
-            raise ValueError("The node is already marked")
+class RunFormation:
+    """
+    What the run formation strategies share. A subclass yields its runs
+    from `iter_runs`; `write_runs` streams them to tapes and `sort` keeps
+    them in main memory, and both report the registers, runs, time and
+    comparisons (`_estimate_comparisons`) to `stats` (a
+    `utils.stats.SortStats`), if given.
+    """
+    def __init__(self, main_memory_size: int, registers: Iterable, stats=None, key: Optional[KeyExtractor] = None) -> None:
+        if main_memory_size < 1:
+            raise ValueError("The main memory must hold at least one register")
 
-    def unmark(self) -> None:
-        if self._is_marked:
-            self._is_marked = False
-        else:
-            raise ValueError("The node is already unmarked")
+        self._main_memory_size: int = main_memory_size
+        self._stats = stats
+        self._key: Optional[KeyExtractor] = key
+        self._registers: Iterable = registers
+        self._sorted_sequences: Optional[List] = None
 
-    def __gt__(self, other: 'Node') -> bool:
-        if self._is_marked and not other._is_marked:
-            return True
-        elif not self._is_marked and other._is_marked:
-            return False
-        else:
-            return self._value > other._value
+    def iter_runs(self) -> Iterator[Iterable]:
+        raise NotImplementedError
 
-    def __ge__(self, other: 'Node') -> bool:
-        if self._is_marked and not other._is_marked:
-            return True
-        elif not self._is_marked and other._is_marked:
-            return False
-        else:
-            return self._value >= other._value
+    def _sort(self) -> List:
+        # every run in main memory, `sort` times and reports it
+        return list(self.iter_runs())
 
-    def __lt__(self, other: 'Node') -> bool:
-        if self._is_marked and not other._is_marked:
-            return False
-        elif not self._is_marked and other._is_marked:
-            return True
-        else:
-            return self._value < other._value
+    def _estimate_comparisons(self, num_registers: int) -> Optional[int]:
+        # None: the estimate of `SortStats.generated_runs`, for a heap
+        return None
 
-class Heap:
-    def __init__(self, main_memory_size: int, registers: List[int]) -> None:
-        self._main_memory_size: int = main_memory_size
-        self._registers: List[int] = registers.copy()
-        self._last_min_node: Union[None, Node] = None
-        self._heap_size: int = 0
-        self._sorted_sequences: List[List[int]] = [[]]
-        self._i_sorted_sequence: int = 0
-        self._heap: List[Node] = []
+    def write_runs(self, tapes: Sequence) -> int:
+        """
+        Streams each run straight to `tapes`, distributed round-robin.
+        Returns the number of runs written.
+        """
+        start_time: float = time.perf_counter()
+        num_runs: int = 0
+        num_registers: int = 0
+        for run in self.iter_runs():
+            num_registers += tapes[num_runs % len(tapes)].append(run)
+            num_runs += 1
+        self._report(num_registers, num_runs, time.perf_counter() - start_time)
+        return num_runs
+
+    def sort(self) -> List:
+        """
+        Returns every run in main memory.
+        """
+        if self._sorted_sequences is not None:
+            return self._sorted_sequences
+
+        start_time: float = time.perf_counter()
+        self._sorted_sequences = self._sort()
+        num_registers: int = sum(map(len, self._sorted_sequences))
+        self._report(num_registers, len(self._sorted_sequences), time.perf_counter() - start_time)
+        return self._sorted_sequences
+
+    def _report(self, num_registers: int, num_runs: int, seconds: float) -> None:
+        if self._stats is not None:
+            self._stats.generated_runs(num_registers, num_runs, self._main_memory_size, seconds,
+                                       comparisons=self._estimate_comparisons(num_registers))
+
+class Heap(RunFormation):
+    """
+    Generates the initial sorted sequences (runs) by replacement selection.
+
+    Records are kept in a `heapq` list of (run_number, value) pairs: a record
+    smaller than the last one written belongs to the next run, so it sinks
+    below every record of the current run without any marking.
+
+    `registers` may be any iterable (a list, a generator, `read_registers`
+    over a file...). It is consumed lazily, so `iter_runs` and `write_runs`
+    never hold more than `main_memory_size` registers.
+
+    `sort` (inlined here) and `write_runs` come from `RunFormation`.
+
+    With a `key` extractor the registers are payloads and the runs hold
+    key/payload records (see `utils/records.py`): the key of each payload
+    is computed once, when it enters the heap, and the heap holds
+    (run_number, key, arrival, record) entries, so payloads are never
+    compared and equal keys keep their input order.
+    """
+    def __init__(self, main_memory_size: int, registers: Iterable, stats=None, key: Optional[KeyExtractor] = None) -> None:
+        super().__init__(main_memory_size, iter(registers), stats, key)
+        self._arrival = count()
+        self._heap: List[Tuple] = []
         self._fill_heap()
 
-    @staticmethod
-    def _parent(i: int) -> int:
-        return (i - 1) // 2
+    def _fill_heap(self) -> None:
+        if self._key is None:
+            self._heap = [(0, x) for x in islice(self._registers, self._main_memory_size)]
+        else:
+            key = self._key
+            self._heap = [(0, k, next(self._arrival), (k, payload))
+                          for k, payload in ((key(payload), payload) for payload in islice(self._registers, self._main_memory_size))]
+        heapq.heapify(self._heap)
 
-    @staticmethod
-    def _left(i: int) -> int:
-        return 2 * i + 1
+    def _replacement_selection(self) -> Iterator[Tuple]:
+        heap = self._heap
+        if self._key is not None:
+            yield from self._keyed_replacement_selection()
+            return
+
+        # while there are registers left, each output is replaced by the next input
+        for x in self._registers:
+            top = heap[0]
+            yield top
+            heapq.heapreplace(heap, (top[0] if x >= top[1] else top[0] + 1, x))
+
+        # then the heap is drained
+        while heap:
+            yield heapq.heappop(heap)
+
+    def _keyed_replacement_selection(self) -> Iterator[Tuple]:
+        heap = self._heap
+        key = self._key
+        arrival = self._arrival
+
+        for payload in self._registers:
+            top = heap[0]
+            yield top
+            k = key(payload)
+            heapq.heapreplace(heap, (top[0] if k >= top[1] else top[0] + 1, k, next(arrival), (k, payload)))
+
+        while heap:
+            yield heapq.heappop(heap)
+
+    def iter_runs(self) -> Iterator[Iterator]:
+        """
+        Yields each run as soon as it starts. A run is a lazy iterator over
+        its registers: a new run starts (in O(1)) when the first record of
+        the next run reaches the top of the heap.
+        """
+        # the register (or key/payload record) is the last item of an entry
+        for _, run in groupby(self._replacement_selection(), key=itemgetter(0)):
+            yield map(itemgetter(-1), run)
+
+    def _sort(self) -> List[List]:
+        # Same runs as `iter_runs`, but inlined since it is about twice as fast as going through generators
+        if self._key is not None:
+            return [list(run) for run in self.iter_runs()]
+
+        heap = self._heap
+        sorted_sequences: List[List[int]] = []
+        # no run until the first register: an empty input has none
+        current_run: int = -1
+        out: List[int] = []
+
+        for x in self._registers:
+            run, value = heap[0]
+            # every record in memory belongs to the next run: O(1), no marks to scan or reset
+            if run != current_run:
+                current_run = run
+                out = []
+                sorted_sequences.append(out)
+            out.append(value)
+            heapq.heapreplace(heap, (run if x >= value else run + 1, x))
+
+        while heap:
+            run, value = heapq.heappop(heap)
+            if run != current_run:
+                current_run = run
+                out = []
+                sorted_sequences.append(out)
+            out.append(value)
+        return sorted_sequences
+
+class LoadSortStore(RunFormation):
+    """
+    Generates the initial runs by loading `main_memory_size` registers,
+    sorting them and storing them as a run. Runs are about half as long as
+    the ones of replacement selection (exactly `main_memory_size`, but the
+    last one), but the sorting is vectorized: with numpy several memory
+    loads are sorted at once, as the rows of one array (`LOAD_SORT_BATCH`
+    registers per call), and without it each one goes through `sorted`.
+
+    Same interface as `Heap`, so either one feeds the methods. With a `key`
+    extractor each load is sorted by the keys of its key/payload records,
+    computed once (and always with `sorted`, which is stable).
+    """
+    def _sorted_loads(self, batch: Sequence) -> List[List]:
+        m = self._main_memory_size
+        if self._key is not None:
+            key = self._key
+            records = [(key(payload), payload) for payload in batch]
+            return [sorted(records[i:i + m], key=record_key) for i in range(0, len(records), m)]
+        if np is None or len(batch) < 2 * m:
+            return [sorted(batch[i:i + m]) for i in range(0, len(batch), m)]
+        try:
+            values = np.asarray(batch, dtype=np.int64)
+        except OverflowError:
+            # registers that do not fit in an int64 stay Python ints
+            return [sorted(batch[i:i + m]) for i in range(0, len(batch), m)]
+        full = len(values) - len(values) % m
+        runs = np.sort(values[:full].reshape(-1, m), axis=1).tolist()
+        if full < len(values):
+            runs.append(np.sort(values[full:]).tolist())
+        return runs
+
+    def iter_runs(self) -> Iterator[List[int]]:
+        """
+        Yields each run, a batch of memory loads at a time.
+        """
+        batch_size = self._main_memory_size * max(1, LOAD_SORT_BATCH // self._main_memory_size)
+        for batch in chunk_records(self._registers, batch_size):
+            yield from self._sorted_loads(batch)
+
+    def _estimate_comparisons(self, num_registers: int) -> int:
+        # about log2(m) comparisons per register, sorting each memory load
+        return round(num_registers * math.log2(self._main_memory_size))
+
+class CountingRuns(RunFormation):
+    """
+    Generates the initial runs by counting the registers: main memory holds
+    `main_memory_size` distinct values with their counts, and a run (a
+    `CountedRun`) is stored whenever one more value would not fit. Over
+    low-cardinality keys a run holds any number of records, and if the
+    whole input has at most `main_memory_size` distinct values it is a
+    single run, so the methods skip the merge phases entirely.
+
+    Same interface as `Heap`. The runs are (value, count) entries on a
+    `CountedTape` and plain registers on any other tape.
+    """
+    def __init__(self, main_memory_size: int, registers: Iterable, stats=None, key: Optional[KeyExtractor] = None) -> None:
+        if key is not None:
+            raise ValueError("Counting runs only hold int registers, not key/payload records")
+        super().__init__(main_memory_size, registers, stats)
+        self._comparisons: int = 0
+
+    def _run(self, counts: Dict[int, int]) -> CountedRun:
+        # about log2(d) comparisons per distinct value, sorting them
+        self._comparisons += round(len(counts) * math.log2(len(counts))) if len(counts) > 1 else 0
+        return CountedRun(sorted(counts.items()), sum(counts.values()))
+
+    def iter_runs(self) -> Iterator[CountedRun]:
+        """
+        Yields each run, counting a memory load of registers at a time.
+        """
+        m = self._main_memory_size
+        counts: Counter = Counter()
+        for chunk in chunk_records(self._registers, max(m, COUNT_BATCH)):
+            chunk_counts = Counter(chunk)
+            if len(counts) + len(chunk_counts) <= m or len(counts.keys() | chunk_counts.keys()) <= m:
+                counts.update(chunk_counts)
+                continue
+            # the memory fills up within this load: register by register
+            for x in chunk:
+                if x not in counts and len(counts) == m:
+                    yield self._run(counts)
+                    counts = Counter()
+                counts[x] += 1
+        if counts:
+            yield self._run(counts)
+
+    def _estimate_comparisons(self, num_registers: int) -> int:
+        return self._comparisons
+
+class NaturalRuns(RunFormation):
+    """
+    Adaptive replacement selection: the same runs as `Heap`, but ordered
+    stretches of the input skip the heap work.
+
+    The records of the current run in memory are kept as a sorted list
+    while the input ascends, so writing the smallest one and storing the
+    next one are O(1) (a stray record is inserted with `bisect`). Only when
+    the input is disordered (insertions keep shifting more than
+    `NATURAL_SHIFT` records) the list becomes a heap, and once an ascending
+    stretch outgrows the memory it is sorted back into a list.
+    Records of the next run that arrive in decreasing order are kept in
+    arrival order and reversed when that run starts. A sorted input is
+    copied with a lag of `main_memory_size` records, and a reverse sorted
+    one is reversed `main_memory_size` records at a time, with no heap
+    operation at all.
+
+    Same interface as `Heap`, `key` included.
+    """
+    def __init__(self, main_memory_size: int, registers: Iterable, stats=None, key: Optional[KeyExtractor] = None) -> None:
+        super().__init__(main_memory_size, registers, stats, key)
+        # registers stored in a heap, the others were appended to (or inserted in) a sorted list
+        self.heap_registers: int = 0
 
     @staticmethod
-    def _right(i: int) -> int:
-        return 2 * i + 2
-
-    def _swap(self, i: int, j: int) -> None:
-        self._heap[i], self._heap[j] = self._heap[j], self._heap[i]
-
-    def _min_heapify(self, i: int) -> None:
-        left = self._left(i)
-        right = self._right(i)
-        smallest = i
-        if left < self._heap_size and self._heap[left] < self._heap[i]:
-            smallest = left
-        if right < self._heap_size and self._heap[right] < self._heap[smallest]:
-            smallest = right
-        if smallest != i:
-            self._swap(i, smallest)
-            self._min_heapify(smallest)
-
-    def _extract_min(self) -> Node:
-        if self._heap_size < 1:
-            raise ValueError("Heap underflow")
-        min_node = self._heap[0]
-        self._last_min_node = min_node
-
-        self._heap[0] = self._heap[self._heap_size - 1]
-        self._heap.pop()
-
-        self._heap_size -= 1
-        self._min_heapify(0)
-        return min_node
-
-    def _insert(self, node: Node) -> None:
-        self._heap_size += 1
-        if self._heap_size > self._main_memory_size:
-            raise ValueError("Heap overflow")
-
-        if self._last_min_node is not None and node < self._last_min_node:
-            node.mark()
-
-        self._heap.append(node)
-        i: int = self._heap_size - 1
-        while i > 0 and self._heap[self._parent(i)] > self._heap[i]:
-            self._swap(i, self._parent(i))
-            i = self._parent(i)
+    def _next_run(nxt: List, desc: List) -> Tuple[List, bool]:
+        """
+        The records of the next run, once it starts: a heap, or the
+        decreasing ones reversed into a sorted list (True).
+        """
+        if nxt:
+            nxt += desc
+            heapq.heapify(nxt)
+            return nxt, False
+        return desc[::-1], True
 
-    def _fill_heap(self) -> None:
-        for _ in range(min(self._main_memory_size, len(self._registers))):
-            self._insert(Node(self._registers.pop(0)))
+    def _natural_runs(self) -> Iterator[Tuple[int, List]]:
+        """
+        Yields (run, registers) batches, the runs numbered in the order they are written.
+        """
+        m = self._main_memory_size
+        key = self._key
+        if key is None:
+            entries = iter(self._registers)
+        else:
+            # (key, arrival, record): equal keys keep their input order, payloads are never compared
+            entries = ((k, n, (k, payload)) for n, (k, payload) in enumerate((key(payload), payload) for payload in self._registers))
 
-    def _check_marked_nodes(self) -> None:
-        if all([node.is_marked for node in self._heap]):
-            self._unmark_nodes()
-            self._i_sorted_sequence += 1
+        cur: List = [] # records of the current run: sorted from `head` on, or a heap
+        head: int = 0
+        ordered: bool = True
+        misses: int = 0 # costly insertions in the sorted list, net of the cheap ones
+        nxt: List = [] # heap of records of the next run
+        desc: List = [] # records of the next run, while they arrive in decreasing order (and `nxt` is empty);
+                        # keyed entries are never equal, so equal keys keep their order
+        size: int = 0 # records in memory
+        run: int = 0
+        last = None # key of the last record written to `run`, None until it starts
+        out: List = [] # registers written to `run`, not yielded yet
+        stretch: int = 0 # length of the ascending stretch of the input
+        prev = None
 
-            if self._i_sorted_sequence > len(self._sorted_sequences) - 1:
-                self._sorted_sequences.append([])
+        for e in entries:
+            if ordered and size == m and head < len(cur) and e >= cur[head]:
+                # steady state of the sorted list: the oldest record is written and `e`
+                # appended (or inserted near the end), until a record of the next run
+                start, tail = head, cur[-1]
+                for e in chain((e,), islice(entries, NATURAL_BATCH)):
+                    if e >= tail:
+                        cur.append(e)
+                        tail = e
+                    elif e >= cur[head]:
+                        at = bisect.bisect_right(cur, e, head)
+                        if len(cur) - at > NATURAL_SHIFT:
+                            break
+                        cur.insert(at, e)
+                    else:
+                        break
+                    head += 1
+                else:
+                    e = None
+                out += cur[start:head] if key is None else map(itemgetter(2), cur[start:head])
+                last = cur[head - 1] if key is None else cur[head - 1][0]
+                prev, stretch, misses = None, 0, max(0, misses - (head - start))
+                if head >= NATURAL_COMPACT and 2 * head >= len(cur):
+                    del cur[:head]
+                    head = 0
+                if len(out) >= NATURAL_BATCH:
+                    yield run, out
+                    out = []
+                if e is None:
+                    continue
 
-    def _unmark_nodes(self) -> None:
-        for node in self._heap:
-            node.unmark()
+            k = e if key is None else e[0]
+            stretch = stretch + 1 if prev is not None and k >= prev else 1
+            prev = k
 
-    def sort(self) -> List[List[int]]:
-        while self._heap_size > 0:
-            self._check_marked_nodes()
-            min_node = self._extract_min()
-            self._sorted_sequences[self._i_sorted_sequence].append(min_node.value)
+            if size == m:
+                # write the smallest record of the current run, starting the next run if it has none left
+                if (head == len(cur)) if ordered else not cur:
+                    if out:
+                        yield run, out
+                        out = []
+                    run += 1
+                    cur, ordered = self._next_run(nxt, desc)
+                    head, misses, nxt, desc, last = 0, 0, [], [], None
+                if not ordered and stretch > m:
+                    # the input ascends: back to a sorted list
+                    cur.sort()
+                    head, misses, ordered = 0, 0, True
+                if ordered:
+                    w = cur[head]
+                    head += 1
+                    if head >= NATURAL_COMPACT and 2 * head >= len(cur):
+                        del cur[:head]
+                        head = 0
+                else:
+                    w = cur[0]
+                    wk = w if key is None else w[0]
+                    if k >= wk:
+                        # `e` belongs to the current run: a single sift
+                        heapq.heapreplace(cur, e)
+                        self.heap_registers += 1
+                        out.append(w if key is None else w[2])
+                        last = wk
+                        if len(out) >= NATURAL_BATCH:
+                            yield run, out
+                            out = []
+                        continue
+                    heapq.heappop(cur)
+                out.append(w if key is None else w[2])
+                last = w if key is None else w[0]
+                if len(out) >= NATURAL_BATCH:
+                    yield run, out
+                    out = []
+                size -= 1
 
-            if len(self._registers) > 0:
-                self._insert(Node(self._registers.pop(0)))
+            size += 1
+            if last is not None and k < last:
+                if not nxt and (not desc or e <= desc[-1]):
+                    desc.append(e)
+                else:
+                    if desc:
+                        nxt += desc
+                        heapq.heapify(nxt)
+                        desc = []
+                    heapq.heappush(nxt, e)
+                    self.heap_registers += 1
+            elif not ordered:
+                heapq.heappush(cur, e)
+                self.heap_registers += 1
+            else:
+                at = bisect.bisect_right(cur, e, head)
+                cur.insert(at, e)
+                if len(cur) - at <= NATURAL_SHIFT + 1:
+                    misses = max(0, misses - 1)
+                    continue
+                misses += 1
+                if misses > NATURAL_MISSES:
+                    # the input is disordered: a sorted list is already a heap
+                    del cur[:head]
+                    head, ordered = 0, False
 
-        return self._sorted_sequences
+        # then the memory is drained
+        while size:
+            if (head == len(cur)) if ordered else not cur:
+                if out:
+                    yield run, out
+                    out = []
+                run += 1
+                cur, ordered = self._next_run(nxt, desc)
+                head, nxt, desc = 0, [], []
+            if ordered:
+                out.extend(cur[head:] if key is None else (e[2] for e in cur[head:]))
+                size -= len(cur) - head
+                head = len(cur)
+            else:
+                while cur:
+                    w = heapq.heappop(cur)
+                    out.append(w if key is None else w[2])
+                    size -= 1
+        if out:
+            yield run, out
+
+    def iter_runs(self) -> Iterator[Iterator]:
+        """
+        Yields each run as soon as it starts, as a lazy iterator over its registers.
+        """
+        for _, batches in groupby(self._natural_runs(), key=itemgetter(0)):
+            yield chain.from_iterable(map(itemgetter(1), batches))
+
+    def _sort(self) -> List[List]:
+        # the batches of each run are concatenated instead of going through `iter_runs`
+        sorted_sequences: List[List] = []
+        current_run: int = -1
+        for run, batch in self._natural_runs():
+            if run != current_run:
+                current_run = run
+                sorted_sequences.append([])
+            sorted_sequences[-1] += batch
+        return sorted_sequences
+
+    def _estimate_comparisons(self, num_registers: int) -> int:
+        # one comparison per register kept in a sorted list, as many as `Heap` for the others
+        return num_registers + round(self.heap_registers * math.log2(self._main_memory_size))
+
+# Run formation strategies, by name
+RUN_FORMATIONS = {
+    "heap": Heap,
+    "load-sort": LoadSortStore,
+    "counting": CountingRuns,
+    "natural": NaturalRuns,
+}
+
+def _write_chunk_runs(main_memory_size: int, chunk: array, path: str) -> int:
+    """
+    Worker of `parallel_runs`: writes the runs of one chunk to its own run file.
+    """
+    return write_run_file(path, Heap(main_memory_size, chunk).iter_runs())
+
+def parallel_runs(registers: Iterable[int], main_memory_size: int, run_dir: str,
+                  workers: Optional[int] = None, chunk_size: int = PARALLEL_CHUNK) -> RunManifest:
+    """
+    Generates the runs on `workers` processes (every core by default).
+    `registers` is split in chunks of `chunk_size` registers and each chunk
+    goes through replacement selection in a worker, which writes its runs to
+    its own run file under `run_dir`. Runs never span two chunks, so there
+    may be one run more per chunk than with a single `Heap`.
+
+    Returns the manifest of the run files (also saved as `run_dir/manifest`),
+    with the runs in input order, ready to be handed to the methods.
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    paths: List[str] = []
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for i, chunk in enumerate(chunk_records(registers, chunk_size)):
+            paths.append(os.path.join(run_dir, f"runs-{i:06d}.bin"))
+            pending.append(pool.submit(_write_chunk_runs, main_memory_size, array(RECORD_TYPE, chunk), paths[-1]))
+            # at most two chunks per worker are kept in main memory
+            if len(pending) >= 2 * workers:
+                pending.popleft().result()
+        for future in pending:
+            future.result()
+
+    manifest = RunManifest(paths)
+    manifest.save(os.path.join(run_dir, "manifest"))
+    return manifest
+
+def _marking_sort(main_memory_size: int, registers: List[int]) -> List[List[int]]:
+    """
+    Reference replacement selection that marks the records of the next run
+    and starts a new run once every record in memory is marked. It pays
+    O(m) per record and is only used to check `Heap`.
+    """
+    memory: List[List[int]] = [[0, x] for x in registers[:main_memory_size]]  # [is_marked, value]
+    i: int = len(memory)
+    sorted_sequences: List[List[int]] = [[]]
+    while memory:
+        if all(is_marked for is_marked, _ in memory):
+            for node in memory:
+                node[0] = 0
+            sorted_sequences.append([])
+        node = min(memory)
+        sorted_sequences[-1].append(node[1])
+        if i < len(registers):
+            node[0], node[1] = int(registers[i] < node[1]), registers[i]
+            i += 1
+        else:
+            memory.remove(node)
+    return sorted_sequences
 
 if __name__ == "__main__":
     import random
-    sorted_seqs = Heap(
-        main_memory_size=10,
-        registers=[random.randint(0,100) for _ in range(10_000)],
-    ).sort()
+    from itertools import accumulate
+    from utils.tape import MemoryTape
+
+    # The run boundaries must match the ones of the marking algorithm
+    for main_memory_size in (1, 2, 3, 10, 60, 500):
+        registers = [random.randint(0, 100) for _ in range(5_000)]
+        expected = _marking_sort(main_memory_size, registers)
+        sorted_seqs = Heap(main_memory_size=main_memory_size, registers=registers).sort()
+        assert sorted_seqs == expected
+        boundaries = list(accumulate(len(seq) for seq in sorted_seqs))
+        print(f"m={main_memory_size}: {len(sorted_seqs)} runs, boundaries match ({boundaries[:5]}...)")
+
+        # Load-sort-store: runs of exactly m registers, each one sorted
+        loads = LoadSortStore(main_memory_size=main_memory_size, registers=registers).sort()
+        assert loads == [sorted(registers[i:i + main_memory_size]) for i in range(0, len(registers), main_memory_size)]
+        print(f"m={main_memory_size}: {len(loads)} runs with load-sort-store")
+
+    # Natural runs: each run sorted, together a permutation of the input, and the same runs as the heap,
+    # over inputs that go through every path (sorted lists, heaps, descending records, compaction)
+    def sawtooth(n: int) -> List[int]:
+        # ascending and descending stretches of random lengths, so the sorted list and the heap alternate
+        registers: List[int] = []
+        while len(registers) < n:
+            stretch = sorted(random.randint(0, 1_000) for _ in range(random.choice([5, 50, 500, 3_000])))
+            registers += stretch if random.random() < 0.5 else stretch[::-1]
+        return registers[:n]
+
+    def nearly_sorted(n: int) -> List[int]:
+        registers = sorted(random.randint(0, 1_000) for _ in range(n))
+        for _ in range(n // 100):
+            i, j = random.randrange(n), random.randrange(n)
+            registers[i], registers[j] = registers[j], registers[i]
+        return registers
+
+    inputs = {
+        "sorted": sorted(random.randint(0, 1_000) for _ in range(5_000)),
+        "reversed": sorted((random.randint(0, 1_000) for _ in range(5_000)), reverse=True),
+        "random": [random.randint(0, 1_000) for _ in range(5_000)],
+        "nearly sorted": nearly_sorted(5_000),
+        "sawtooth": sawtooth(20_000),
+        "few unique": [random.randint(0, 3) for _ in range(5_000)],
+        # the descent writes the sorted list one record at a time, compacting it
+        "up and down": list(range(5_000)) + list(range(5_000, 0, -1)),
+    }
+    for main_memory_size in (1, 2, 3, 10, 60, 500, 2_000):
+        heap_registers: int = 0
+        for name, registers in inputs.items():
+            natural = NaturalRuns(main_memory_size=main_memory_size, registers=registers)
+            runs = natural.sort()
+            assert all(run == sorted(run) for run in runs), name
+            assert sorted(chain.from_iterable(runs)) == sorted(registers), name
+            assert runs == Heap(main_memory_size=main_memory_size, registers=registers).sort(), name
+            assert [list(run) for run in NaturalRuns(main_memory_size=main_memory_size, registers=registers).iter_runs()] == runs, name
+            tapes = [MemoryTape(), MemoryTape()]
+            NaturalRuns(main_memory_size=main_memory_size, registers=iter(registers)).write_runs(tapes)
+            assert [list(run) for tape in tapes for run in tape] == runs[0::2] + runs[1::2], name
+            heap_registers += natural.heap_registers
 
-    print(sorted_seqs)
+            # with a key extractor equal keys keep their input order, as in the heap
+            keyed = NaturalRuns(main_memory_size=main_memory_size, registers=registers, key=lambda x: x // 10).sort()
+            assert keyed == Heap(main_memory_size=main_memory_size, registers=registers, key=lambda x: x // 10).sort(), name
+        total = sum(map(len, inputs.values()))
+        print(f"m={main_memory_size}: natural runs match the heap over {len(inputs)} inputs ({heap_registers} of {total} registers through a heap)")
@@ -0,0 +1,129 @@
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence
+
+class _Exhausted:
+    """
+    Head of a run with no records left: it loses every match.
+    """
+    def __lt__(self, other) -> bool:
+        return False
+
+    def __gt__(self, other) -> bool:
+        return other is not self
+
+    def __repr__(self) -> str:
+        return "_EXHAUSTED"
+
+_EXHAUSTED = _Exhausted()
+
+def merge_comparisons(run_lengths: Sequence[int]) -> int:
+    """
+    Matches played by `merge_runs` over runs of `run_lengths` records: k - 1
+    to build the tree, then one per level from the leaf of each record
+    output up to the root.
+    """
+    k: int = len(run_lengths)
+    if k < 2:
+        return 0
+    return k - 1 + sum(length * ((i + k).bit_length() - 1) for i, length in enumerate(run_lengths))
+
+def merge_runs(runs: Sequence[Iterable], key: Optional[Callable[[Any], Any]] = None) -> Iterator:
+    """
+    Streams the k-way merge of the sorted `runs` (lists, tapes, generators...)
+    with a loser tree (tournament tree).
+
+    Only the head of each run is kept in main memory and each record costs
+    about log2(k) comparisons, with no intermediate lists. Equal records
+    come out in run order, so the merge is stable.
+
+    With `key` the records are compared by `key(record)`, taken once per
+    record (e.g. `utils.records.record_key` for key/payload records).
+    """
+    iters: List[Iterator] = [iter(run) for run in runs]
+    k: int = len(iters)
+    if k == 0:
+        return
+    if k == 1:
+        yield from iters[0]
+        return
+    if key is not None:
+        yield from _merge_by_key(iters, key)
+        return
+
+    heads: List = [next(it, _EXHAUSTED) for it in iters]
+
+    # Leaves (runs) sit at positions k..2k-1; tree[node] keeps the loser of the
+    # match played at `node`, winners[1] the run that won the whole tournament.
+    tree: List[int] = [0] * k
+    winners: List[int] = [0] * k + list(range(k))
+    for node in range(k - 1, 0, -1):
+        a, b = winners[2 * node], winners[2 * node + 1]
+        if heads[b] < heads[a] or (heads[b] == heads[a] and b < a):
+            a, b = b, a
+        winners[node], tree[node] = a, b
+
+    w: int = winners[1]
+    while True:
+        key = heads[w]
+        if key is _EXHAUSTED:
+            return
+        yield key
+
+        # Replay the matches from the winner's leaf up to the root
+        heads[w] = key = next(iters[w], _EXHAUSTED)
+        node: int = (w + k) >> 1
+        while node:
+            loser = tree[node]
+            loser_key = heads[loser]
+            if loser_key < key or (loser_key == key and loser < w):
+                tree[node] = w
+                w, key = loser, loser_key
+            node >>= 1
+
+def _merge_by_key(iters: List[Iterator], key: Callable[[Any], Any]) -> Iterator:
+    """
+    `merge_runs` comparing `key(record)` instead of the records: the same
+    loser tree, with the keys of the heads kept apart from the records.
+    """
+    k: int = len(iters)
+    records: List = [next(it, _EXHAUSTED) for it in iters]
+    heads: List = [_EXHAUSTED if record is _EXHAUSTED else key(record) for record in records]
+
+    tree: List[int] = [0] * k
+    winners: List[int] = [0] * k + list(range(k))
+    for node in range(k - 1, 0, -1):
+        a, b = winners[2 * node], winners[2 * node + 1]
+        if heads[b] < heads[a] or (heads[b] == heads[a] and b < a):
+            a, b = b, a
+        winners[node], tree[node] = a, b
+
+    w: int = winners[1]
+    while True:
+        record = records[w]
+        if record is _EXHAUSTED:
+            return
+        yield record
+
+        records[w] = record = next(iters[w], _EXHAUSTED)
+        heads[w] = head = _EXHAUSTED if record is _EXHAUSTED else key(record)
+        node: int = (w + k) >> 1
+        while node:
+            loser = tree[node]
+            loser_key = heads[loser]
+            if loser_key < head or (loser_key == head and loser < w):
+                tree[node] = w
+                w, head = loser, loser_key
+            node >>= 1
+
+if __name__ == "__main__":
+    import random
+
+    runs = [sorted(random.randint(0, 100) for _ in range(random.randint(0, 20))) for _ in range(7)]
+    merged = list(merge_runs(runs))
+    assert merged == sorted(x for run in runs for x in run)
+    print(merge_comparisons([len(run) for run in runs]), "matches")
+    print(merged)
+
+    # Key/payload records: compared by key only, stable on equal keys
+    record_runs = [[(x, f"{i}:{j}") for j, x in enumerate(run)] for i, run in enumerate(runs)]
+    merged_records = list(merge_runs(record_runs, key=lambda record: record[0]))
+    assert merged_records == sorted((record for run in record_runs for record in run), key=lambda record: record[0])
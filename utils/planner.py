@@ -0,0 +1,104 @@
+from typing import List, NamedTuple, Sequence
+import heapq
+
+class MergeStep(NamedTuple):
+    """
+    One merge of the plan: the runs `inputs` (ids) are merged into the run
+    `output`, of `length` records. `level` is 1 + the highest level of the
+    merges that produced its inputs, so the merges of a level only depend
+    on the ones of the previous levels.
+    """
+    inputs: List[int]
+    output: int
+    length: int
+    level: int
+
+class MergePlan:
+    """
+    A merge schedule over runs of `run_lengths` records. Run `i` of the
+    input has id `i`, the dummy runs come next and the run written by the
+    `j`-th step gets id `num_runs + num_dummies + j`.
+    """
+    def __init__(self, run_lengths: Sequence[int], fan_in: int, num_dummies: int, steps: List[MergeStep]) -> None:
+        self.run_lengths: List[int] = list(run_lengths)
+        self.fan_in: int = fan_in
+        self.num_dummies: int = num_dummies
+        self.steps: List[MergeStep] = steps
+
+    @property
+    def num_records(self) -> int:
+        return sum(self.run_lengths)
+
+    @property
+    def cost(self) -> int:
+        """
+        Records written by every merge of the plan.
+        """
+        return sum(step.length for step in self.steps)
+
+    @property
+    def alpha(self) -> float:
+        """
+        Predicted `alpha`: records written over the number of records.
+        """
+        return self.cost / self.num_records if self.num_records else 0.0
+
+    @property
+    def num_levels(self) -> int:
+        return max((step.level for step in self.steps), default=0)
+
+    def is_dummy(self, run_id: int) -> bool:
+        return len(self.run_lengths) <= run_id < len(self.run_lengths) + self.num_dummies
+
+    def levels(self) -> List[List[MergeStep]]:
+        """
+        The steps grouped by level, in the order they were planned.
+        """
+        levels: List[List[MergeStep]] = [[] for _ in range(self.num_levels)]
+        for step in self.steps:
+            levels[step.level - 1].append(step)
+        return levels
+
+    def __repr__(self) -> str:
+        return f"MergePlan(runs={len(self.run_lengths)}, fan_in={self.fan_in}, dummies={self.num_dummies}, merges={len(self.steps)}, alpha={self.alpha:.2f})"
+
+def plan_merges(run_lengths: Sequence[int], max_open_files: int) -> MergePlan:
+    """
+    Minimum total write merge schedule (Huffman's algorithm with a fan-in
+    of `max_open_files - 1`, one file being the output): the shortest runs
+    are always merged first, so the longest ones are copied the fewest
+    times.
+
+    Zero-length dummy runs are added so that every merge takes exactly
+    `fan_in` runs, which keeps the short runs out of the last merge.
+    """
+    fan_in: int = max(2, max_open_files - 1)
+    num_runs: int = len(run_lengths)
+    num_dummies: int = (-(num_runs - 1)) % (fan_in - 1) if num_runs > 1 else 0
+
+    # (length, id, level): ties go to the older runs, so the plan is deterministic
+    heap = [(length, i, 0) for i, length in enumerate(run_lengths)]
+    heap += [(0, num_runs + i, 0) for i in range(num_dummies)]
+    heapq.heapify(heap)
+
+    steps: List[MergeStep] = []
+    next_id: int = num_runs + num_dummies
+    while len(heap) > 1:
+        group = [heapq.heappop(heap) for _ in range(min(fan_in, len(heap)))]
+        length = sum(length for length, _, _ in group)
+        level = 1 + max(level for _, _, level in group)
+        steps.append(MergeStep([i for _, i, _ in group], next_id, length, level))
+        heapq.heappush(heap, (length, next_id, level))
+        next_id += 1
+
+    return MergePlan(run_lengths, fan_in, num_dummies, steps)
+
+if __name__ == "__main__":
+    import random
+
+    lengths = [random.randint(1, 50) for _ in range(20)]
+    for k in (3, 4, 6):
+        plan = plan_merges(lengths, k)
+        print(plan)
+        for level, steps in enumerate(plan.levels(), start=1):
+            print(f"  level {level}:", ", ".join(f"{step.inputs} -> {step.output} ({step.length})" for step in steps))
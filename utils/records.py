@@ -0,0 +1,136 @@
+"""
+Key/payload records.
+
+A record is a `(key, payload)` tuple: the `key` is computed once, by
+the run formation (`Heap(key=...)`), from the payload (`bytes`) with a
+user-supplied key extractor, and carried along with it. The merges only
+compare the keys (`merge_runs(key=record_key)`), so a payload is never
+decoded again. Keys are ints, or `bytes` compared by memcmp for composite
+orders (see `utils/keys.py`).
+
+On disk the records are packed by a `RecordLayout`:
+
+    fixed    | int64 key, payload of exactly `payload_size` bytes
+    variable | int64 key, uint32 payload length, payload
+
+With `byte_keys` the int64 key is replaced by a uint16 key length
+(before the payload length, if any) and the key follows the header.
+"""
+
+from typing import Callable, Iterable, Iterator, Optional, Tuple, Union
+from operator import itemgetter
+import struct
+
+Record = Tuple[Union[int, bytes], bytes]
+KeyExtractor = Callable[[bytes], Union[int, bytes]]
+
+# Key of a record, already computed
+record_key = itemgetter(0)
+
+def make_records(payloads: Iterable[bytes], key: KeyExtractor) -> Iterator[Record]:
+    """
+    Pairs each payload with its key, computed once.
+    """
+    return ((key(payload), payload) for payload in payloads)
+
+def record_str(record) -> str:
+    """
+    A register or the key of a record, as printed in the phases (in hex
+    for the `bytes` keys). The (value, count) entries of the counted runs
+    (`utils.tape.CountedRun`) are printed as `count` registers.
+    """
+    if not isinstance(record, tuple):
+        return str(record)
+    if isinstance(record[1], int):
+        return " ".join([str(record[0])] * record[1])
+    return record[0].hex() if isinstance(record[0], bytes) else str(record[0])
+
+class RecordLayout:
+    """
+    Packed layout of the records on a tape. With `payload_size` the
+    payloads have a fixed size and, with int keys, the records are unpacked
+    in bulk with `struct.iter_unpack`; otherwise each payload is prefixed
+    by its length. `byte_keys` stores `bytes` keys instead of int64 ones.
+    """
+    def __init__(self, payload_size: Optional[int] = None, byte_keys: bool = False) -> None:
+        if payload_size is not None and payload_size < 0:
+            raise ValueError("A payload can not have a negative size")
+
+        self.payload_size: Optional[int] = payload_size
+        self.byte_keys: bool = byte_keys
+        key_format = "H" if byte_keys else "q"
+        if payload_size is None:
+            self._struct = struct.Struct(f"<{key_format}I")
+        elif byte_keys:
+            self._struct = struct.Struct("<H")
+        else:
+            self._struct = struct.Struct(f"<q{payload_size}s")
+
+    @property
+    def fixed(self) -> bool:
+        return self.payload_size is not None
+
+    def record_size(self, record: Record) -> int:
+        """
+        Bytes taken by `record` once packed.
+        """
+        key, payload = record
+        return (self._struct.size + (len(key) if self.byte_keys else 0)
+                + (self.payload_size if self.fixed and self.byte_keys else 0) + (0 if self.fixed else len(payload)))
+
+    def pack_into(self, buffer: bytearray, record: Record) -> None:
+        """
+        Appends `record`, packed, to `buffer`.
+        """
+        key, payload = record
+        if self.fixed and len(payload) != self.payload_size:
+            raise ValueError(f"Payload of {len(payload)} bytes in a layout of {self.payload_size} bytes")
+        if self.byte_keys:
+            buffer += self._struct.pack(len(key)) if self.fixed else self._struct.pack(len(key), len(payload))
+            buffer += key
+            buffer += payload
+        elif self.fixed:
+            buffer += self._struct.pack(key, payload)
+        else:
+            buffer += self._struct.pack(key, len(payload))
+            buffer += payload
+
+    def unpack(self, buffer, count: int) -> Iterator[Record]:
+        """
+        Reads the `count` records packed at the start of `buffer`.
+        """
+        if self.fixed and not self.byte_keys:
+            yield from self._struct.iter_unpack(buffer[:count * self._struct.size])
+            return
+
+        header = self._struct
+        offset: int = 0
+        for _ in range(count):
+            if not self.byte_keys:
+                key, length = header.unpack_from(buffer, offset)
+                offset += header.size
+            else:
+                if self.fixed:
+                    key_length, = header.unpack_from(buffer, offset)
+                    length = self.payload_size
+                else:
+                    key_length, length = header.unpack_from(buffer, offset)
+                offset += header.size
+                key = bytes(buffer[offset:offset + key_length])
+                offset += key_length
+            yield key, bytes(buffer[offset:offset + length])
+            offset += length
+
+    def __repr__(self) -> str:
+        return f"RecordLayout(payload_size={self.payload_size}, byte_keys={self.byte_keys})"
+
+if __name__ == "__main__":
+    records = list(make_records([b"30 c", b"4 a", b"17 bb"], key=lambda row: int(row.split()[0])))
+    for layout in (RecordLayout(), RecordLayout(payload_size=5), RecordLayout(byte_keys=True), RecordLayout(payload_size=5, byte_keys=True)):
+        buffer = bytearray()
+        packed = [(str(key).encode() if layout.byte_keys else key, payload.ljust(5) if layout.fixed else payload) for key, payload in records]
+        for record in packed:
+            layout.pack_into(buffer, record)
+        assert len(buffer) == sum(map(layout.record_size, packed))
+        assert list(layout.unpack(buffer, len(packed))) == packed
+        print(layout, len(buffer), "bytes:", packed)
@@ -0,0 +1,217 @@
+"""
+Packed binary run format.
+
+    header  | magic b"RUNS", uint32 version, uint64 run count, uint64 index offset
+    records | little-endian int64 keys, one run after the other
+    index   | (run count + 1) uint64 offsets, in records: run i is records[index[i]:index[i+1]]
+
+Records are written in bulk through `array` and read back zero-copy: a run is
+a `memoryview` over the memory-mapped file, so a record is only turned into
+a Python int when the merge reads it.
+"""
+
+from typing import Iterable, Iterator, List, Sequence
+from array import array
+from bisect import bisect_right
+from itertools import islice
+import mmap
+import struct
+import sys
+
+MAGIC = b"RUNS"
+VERSION = 1
+HEADER = struct.Struct("<4sIQQ")
+RECORD_TYPE = 'q'
+RECORD_SIZE = array(RECORD_TYPE).itemsize
+# Records packed per bulk write
+CHUNK_RECORDS = 8192
+
+def chunk_records(records: Iterable[int], chunk_size: int = CHUNK_RECORDS) -> Iterator[Sequence[int]]:
+    """
+    Splits `records` in chunks of at most `chunk_size` records.
+    """
+    if isinstance(records, (list, array, memoryview)):
+        return (records[i:i + chunk_size] for i in range(0, len(records), chunk_size))
+    it = iter(records)
+    return iter(lambda: list(islice(it, chunk_size)), [])
+
+def pack(chunk: Sequence[int]) -> array:
+    """
+    Packs `chunk` as little-endian int64.
+    """
+    packed = array(RECORD_TYPE, chunk)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed
+
+def pack_records(records: Iterable[int]) -> Iterator[array]:
+    """
+    Groups `records` into `array`s of at most `CHUNK_RECORDS` little-endian int64.
+    """
+    return map(pack, chunk_records(records))
+
+def view_records(buffer, start: int, length: int) -> memoryview:
+    """
+    Zero-copy view of `length` records starting at record `start` of `buffer`.
+    """
+    view = memoryview(buffer)[start * RECORD_SIZE:(start + length) * RECORD_SIZE].cast(RECORD_TYPE)
+    if sys.byteorder == "big":
+        # Records are little-endian on disk, so they must be copied and swapped
+        swapped = array(RECORD_TYPE, view.tobytes())
+        swapped.byteswap()
+        view = memoryview(swapped)
+    return view
+
+class RunFileWriter:
+    """
+    Writes runs to a packed run file. The index and header are only written
+    by `close()`, so runs can be streamed without knowing their number.
+    """
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+        self._offsets: List[int] = [0]
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def append(self, run: Iterable[int]) -> int:
+        length: int = 0
+        for packed in pack_records(run):
+            packed.tofile(self._file)
+            length += len(packed)
+        self._offsets.append(self._offsets[-1] + length)
+        return length
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        index_offset: int = self._file.tell()
+        array('Q', self._offsets).tofile(self._file)
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, len(self), index_offset))
+        self._file.close()
+
+    def __enter__(self) -> 'RunFileWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+def write_run_file(path: str, runs: Iterable[Iterable[int]]) -> int:
+    """
+    Writes `runs` (lists, tapes, `Heap.iter_runs()`...) to a packed run
+    file. Returns the number of runs written.
+    """
+    with RunFileWriter(path) as writer:
+        for run in runs:
+            writer.append(run)
+        return len(writer)
+
+class RunFile:
+    """
+    Read-only, memory-mapped packed run file. It behaves like a list of runs,
+    each run being a `memoryview` of int64 records, so it can be handed to
+    the methods as their initial sorted sequences.
+    """
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, num_runs, index_offset = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"`{path}` is not a run file (version {VERSION}).")
+
+        self._offsets = memoryview(self._mmap)[index_offset:index_offset + (num_runs + 1) * 8].cast('Q')
+        self._data_offset: int = HEADER.size
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> memoryview:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("run index out of range")
+        start: int = self._offsets[i]
+        return view_records(self._mmap, start + self._data_offset // RECORD_SIZE, self._offsets[i + 1] - start)
+
+    def __iter__(self) -> Iterator[memoryview]:
+        return (self[i] for i in range(len(self)))
+
+    def close(self) -> None:
+        self._offsets.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> 'RunFile':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+class RunManifest:
+    """
+    Runs spread over several run files (e.g. one per worker of
+    `utils.heap.parallel_runs`), seen as a single list of runs in the order
+    of `paths`. The manifest itself is a text file with one run file path
+    per line (`save`/`load`).
+    """
+    def __init__(self, paths: Sequence[str]) -> None:
+        self.paths: List[str] = list(paths)
+        self._run_files: List[RunFile] = [RunFile(path) for path in self.paths]
+        # first run of each run file, plus the total
+        self._starts: List[int] = [0]
+        for run_file in self._run_files:
+            self._starts.append(self._starts[-1] + len(run_file))
+
+    @classmethod
+    def load(cls, path: str) -> 'RunManifest':
+        with open(path) as manifest:
+            return cls([line.rstrip("\n") for line in manifest if line.strip()])
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as manifest:
+            manifest.writelines(p + "\n" for p in self.paths)
+
+    def __len__(self) -> int:
+        return self._starts[-1]
+
+    def __getitem__(self, i: int) -> memoryview:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("run index out of range")
+        f = bisect_right(self._starts, i) - 1
+        return self._run_files[f][i - self._starts[f]]
+
+    def __iter__(self) -> Iterator[memoryview]:
+        for run_file in self._run_files:
+            yield from run_file
+
+    def close(self) -> None:
+        for run_file in self._run_files:
+            run_file.close()
+
+    def __enter__(self) -> 'RunManifest':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+if __name__ == "__main__":
+    import os
+    import random
+    import tempfile
+    from utils.heap import Heap
+
+    path = os.path.join(tempfile.gettempdir(), "runs.bin")
+    registers = [random.randint(-100, 100) for _ in range(100)]
+    num_runs = write_run_file(path, Heap(3, registers).iter_runs())
+
+    with RunFile(path) as runs:
+        assert [list(run) for run in runs] == Heap(3, registers).sort()
+        print(f"{num_runs} runs, {os.path.getsize(path)} bytes:", [list(run) for run in runs])
+    os.remove(path)
@@ -0,0 +1,177 @@
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Union
+import math
+
+from utils.merge import merge_comparisons
+from utils.tape import IOCounters, IOTracker, MemoryTape, Tape
+
+class PhaseStats:
+    """
+    What one phase did: key comparisons, records read and written, runs
+    created, the I/O of the tapes (blocks, bytes and time stalled) and the
+    wall time.
+    """
+    __slots__ = ("comparisons", "records_read", "records_written", "runs_created", "seconds", "io")
+
+    def __init__(self, comparisons: int = 0, records_read: int = 0, records_written: int = 0, runs_created: int = 0,
+                 seconds: float = 0.0, io: Optional[IOCounters] = None) -> None:
+        self.comparisons: int = comparisons
+        self.records_read: int = records_read
+        self.records_written: int = records_written
+        self.runs_created: int = runs_created
+        self.seconds: float = seconds
+        self.io: IOCounters = io if io is not None else IOCounters()
+
+    @property
+    def bytes_read(self) -> int:
+        return self.io.bytes_read
+
+    @property
+    def bytes_written(self) -> int:
+        return self.io.bytes_written
+
+    @property
+    def compression_ratio(self) -> float:
+        return self.io.compression_ratio
+
+    def __add__(self, other: 'PhaseStats') -> 'PhaseStats':
+        return PhaseStats(*(getattr(self, f) + getattr(other, f) for f in self.__slots__))
+
+    def as_dict(self) -> dict:
+        return {
+            "comparisons": self.comparisons,
+            "records_read": self.records_read,
+            "records_written": self.records_written,
+            "runs_created": self.runs_created,
+            "seconds": self.seconds,
+            **{f: getattr(self.io, f) for f in IOCounters.__slots__},
+            "compression_ratio": self.compression_ratio,
+        }
+
+    def __repr__(self) -> str:
+        return "PhaseStats(" + ", ".join(f"{f}={v}" for f, v in self.as_dict().items()) + ")"
+
+class SortSimulation(NamedTuple):
+    """
+    What `simulate` of a method predicts for its `sort()` from the run
+    lengths alone: the `alpha` it returns, the `beta` of every phase (as
+    given to `SortObserver.phase_end`) and the records written by the
+    merges of each phase after the distribution (the sum of the lengths
+    given to `SortObserver.merge_done`).
+    """
+    alpha: float
+    betas: List[float]
+    writes_per_phase: List[int]
+
+class SortStats:
+    """
+    Counters of a whole sort, the same for every method: `run_generation`
+    (filled by `Heap`) and one `PhaseStats` per phase, phase 0 being the
+    distribution of the runs over the tapes.
+
+    Records and comparisons are counted per run, from the run lengths,
+    never per record, so the stats are cheap enough to always be on.
+    """
+    def __init__(self, tapes: Sequence[Union[Tape, MemoryTape]] = ()) -> None:
+        self._io = IOTracker(list(tapes))
+        self._current = PhaseStats()
+        self.run_generation: Optional[PhaseStats] = None
+        self.phases: List[PhaseStats] = []
+        self.num_registers: int = 0
+        # alpha of the merge plan, for the methods that follow one (`utils.planner`)
+        self.predicted_alpha: Optional[float] = None
+
+    def generated_runs(self, num_registers: int, num_runs: int, main_memory_size: int, seconds: float,
+                       comparisons: Optional[int] = None) -> None:
+        """
+        Reported by `Heap` (or `LoadSortStore`, which gives its own
+        `comparisons`). The comparisons of `Heap` are estimated: each record
+        costs about log2(m) comparisons sifting through `heapq`, plus one
+        against the last record written.
+        """
+        if comparisons is None:
+            comparisons = round(num_registers * (math.log2(main_memory_size) + 1))
+        self.run_generation = PhaseStats(
+            comparisons=comparisons,
+            records_read=num_registers,
+            records_written=num_registers,
+            runs_created=num_runs,
+            seconds=seconds,
+        )
+
+    def distributed(self, num_runs: int, num_records: int) -> None:
+        """
+        `num_runs` runs holding `num_records` records were written to the tapes.
+        """
+        self._current.runs_created += num_runs
+        self._current.records_written += num_records
+
+    def merged(self, run_lengths: Iterable[int]) -> None:
+        """
+        One merge of runs of `run_lengths` records was written to a tape.
+        """
+        run_lengths = list(run_lengths)
+        records = sum(run_lengths)
+        self._current.comparisons += merge_comparisons(run_lengths)
+        self._current.records_read += records
+        self._current.records_written += records
+        self._current.runs_created += 1
+
+    def end_phase(self) -> PhaseStats:
+        phase, self._current = self._current, PhaseStats()
+        phase.io = self._io.end_phase()
+        phase.seconds = self._io.seconds[-1]
+        self.phases.append(phase)
+        return phase
+
+    def exclude(self) -> None:
+        """
+        Leaves the I/O and time since the end of the last phase out of the
+        next one (e.g. printing the tapes).
+        """
+        self._io.exclude()
+
+    @property
+    def total(self) -> PhaseStats:
+        """
+        Sum of every phase (the run generation is not included).
+        """
+        return sum(self.phases, PhaseStats())
+
+    @property
+    def alpha(self) -> float:
+        """
+        Records written by the merge phases over the number of records,
+        counted the same way for every method.
+        """
+        if not self.num_registers:
+            return 0.0
+        return sum(phase.records_written for phase in self.phases[1:]) / self.num_registers
+
+    def report(self) -> str:
+        """
+        One line per phase: runs, records and comparisons, bytes (and the
+        compression ratio of the ones written, on compressed tapes), then
+        the wall time split between stalled on I/O and merging.
+        """
+        lines: List[str] = []
+        if self.run_generation is not None:
+            g = self.run_generation
+            lines.append(f"runs: {g.runs_created} runs of {g.records_written} records, ~{g.comparisons} comparisons, {g.seconds:.3f}s")
+        for i, p in enumerate(self.phases):
+            lines.append(
+                f"fase {i}: {p.runs_created} runs, {p.records_read} records read, {p.records_written} written, "
+                f"{p.comparisons} comparisons, {p.bytes_read} bytes read, {p.bytes_written} written"
+                + (f" (compressed {p.compression_ratio:.2f}x)" if p.io.raw_bytes_written != p.io.bytes_written else "")
+                + f", {p.seconds:.3f}s (stalled {p.io.stall:.3f}s, merging {p.seconds - p.io.stall:.3f}s)"
+            )
+        lines.append(f"alpha {self.alpha:.2f}" + (f" (predicted {self.predicted_alpha:.2f})" if self.predicted_alpha is not None else ""))
+        return "\n".join(lines)
+
+    def as_dict(self) -> dict:
+        return {
+            "num_registers": self.num_registers,
+            "alpha": self.alpha,
+            "predicted_alpha": self.predicted_alpha,
+            "run_generation": self.run_generation.as_dict() if self.run_generation is not None else None,
+            "phases": [phase.as_dict() for phase in self.phases],
+        }
@@ -0,0 +1,888 @@
+from typing import Deque, Iterable, Iterator, List, Optional, Tuple, Union
+from array import array
+from bisect import bisect_right
+from collections import deque
+from itertools import chain, groupby, repeat
+import mmap
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import weakref
+
+from utils.codec import decode_block, encode_block
+from utils.runfile import RECORD_SIZE, RECORD_TYPE, chunk_records, view_records
+from utils.records import Record, RecordLayout
+
+# Default number of records per block (64 KiB of int64)
+BLOCK_RECORDS = 8192
+
+class IOCounters:
+    """
+    Blocks and bytes moved between main and secondary memory, and the
+    seconds the sort was stalled waiting for a block to be read or for
+    room to write one. `raw_bytes_read` and `raw_bytes_written` are the
+    bytes those blocks hold once decoded: the same as the bytes moved but
+    on a `CompressedTape`.
+    """
+    __slots__ = ("blocks_read", "blocks_written", "bytes_read", "bytes_written", "read_stall", "write_stall",
+                 "raw_bytes_read", "raw_bytes_written")
+
+    def __init__(self, blocks_read: int = 0, blocks_written: int = 0, bytes_read: int = 0, bytes_written: int = 0,
+                 read_stall: float = 0.0, write_stall: float = 0.0, raw_bytes_read: int = 0, raw_bytes_written: int = 0) -> None:
+        self.blocks_read: int = blocks_read
+        self.blocks_written: int = blocks_written
+        self.bytes_read: int = bytes_read
+        self.bytes_written: int = bytes_written
+        self.read_stall: float = read_stall
+        self.write_stall: float = write_stall
+        self.raw_bytes_read: int = raw_bytes_read
+        self.raw_bytes_written: int = raw_bytes_written
+
+    @property
+    def compression_ratio(self) -> float:
+        """
+        Decoded over encoded bytes written (1.0 if nothing was compressed).
+        """
+        return self.raw_bytes_written / self.bytes_written if self.bytes_written else 1.0
+
+    @property
+    def stall(self) -> float:
+        return self.read_stall + self.write_stall
+
+    def __add__(self, other: 'IOCounters') -> 'IOCounters':
+        return IOCounters(*(getattr(self, f) + getattr(other, f) for f in self.__slots__))
+
+    def __sub__(self, other: 'IOCounters') -> 'IOCounters':
+        return IOCounters(*(getattr(self, f) - getattr(other, f) for f in self.__slots__))
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, IOCounters) and all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+    def __repr__(self) -> str:
+        return "IOCounters(" + ", ".join(f"{f}={getattr(self, f)}" for f in self.__slots__) + ")"
+
+class TapeRun:
+    """
+    A run stored on a tape. Its records are read block by block, zero-copy,
+    from the memory-mapped tape when the run is iterated, so holding a
+    `TapeRun` costs O(1) memory.
+    """
+    def __init__(self, tape: 'Tape', offset: int, length: int) -> None:
+        self._tape: 'Tape' = tape
+        self._offset: int = offset # in records
+        self._length: int = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[int]:
+        offset: int = self._offset
+        end: int = self._offset + self._length
+        if self._tape.io_depth and end - offset > self._tape.block_size:
+            for block in self._tape._read_ahead(offset, end):
+                yield from block
+        else:
+            while offset < end:
+                block = self._tape._read_block(offset, min(self._tape.block_size, end - offset), end)
+                yield from block
+                offset += len(block)
+
+    def __repr__(self) -> str:
+        return str(list(self))
+
+    def locate(self) -> Optional[Tuple[str, int, int, int]]:
+        """
+        Where the run lies in its tape file, (path, offset, length,
+        block_size), for another process to read it with `read_tape_run`.
+        The tape is flushed first and the blocks are counted as read. None
+        if only this tape can read it (`CompressedTape`).
+        """
+        return self._tape._locate(self._offset, self._length)
+
+def read_tape_run(path: str, offset: int, length: int, block_size: int = BLOCK_RECORDS) -> Iterator[int]:
+    """
+    Reads a run located by `TapeRun.locate` block by block, with its own
+    file descriptor: the merge workers of `PWays` read their runs this way
+    instead of getting them pickled.
+    """
+    with open(path, 'rb') as file:
+        fd: int = file.fileno()
+        for start in range(offset, offset + length, block_size):
+            block = array(RECORD_TYPE)
+            block.frombytes(os.pread(fd, min(block_size, offset + length - start) * RECORD_SIZE, start * RECORD_SIZE))
+            if sys.byteorder == "big":
+                block.byteswap()
+            yield from block
+
+class Tape:
+    """
+    A file in secondary memory holding a sequence of runs, packed as
+    little-endian int64 records (see `utils/runfile.py`).
+
+    Runs are appended at the end of the file and consumed from the front
+    with `pop(0)`, just like the list of lists the methods used before, but
+    only the run boundaries (offset, length) are kept in main memory.
+
+    I/O is done in blocks of `block_size` records with double buffering:
+    records are written to one buffer while the other one, once full, is
+    flushed to the file, and while a block is being read the kernel is
+    asked to prefetch the next one. `io` counts the blocks and bytes moved.
+
+    With `io_depth` > 0 the I/O runs on background threads instead: full
+    blocks are queued to a write-behind thread, and a run spanning several
+    blocks is read by a read-ahead thread, each queue holding up to
+    `io_depth` blocks. The time spent waiting on those queues is counted
+    as `io.read_stall` and `io.write_stall`.
+
+    Once all its runs were consumed the tape is rewound (truncated) on the
+    next `append`, but a popped run is only a view into the file: while one
+    may still be read the tape keeps growing instead.
+    """
+    def __init__(self, path: str, block_size: int = BLOCK_RECORDS, io_depth: int = 0) -> None:
+        if block_size < 1:
+            raise ValueError("A block must hold at least one record")
+
+        self.path: str = path
+        self.block_size: int = block_size
+        self.io_depth: int = io_depth
+        self.io: IOCounters = IOCounters()
+        self._written: int = 0 # records already in the file, seen by the readers
+        self._write_queue: Optional[queue.Queue] = None
+        self._writer: Optional[threading.Thread] = None
+        self._runs: Deque[TapeRun] = deque()
+        self._popped: weakref.WeakSet = weakref.WeakSet() # popped runs still referenced
+        self._file = open(path, 'w+b')
+        self._mmap: Optional[mmap.mmap] = None
+        self._size: int = 0 # records appended
+        self._flushed: int = 0 # records handed to the file (or to the write-behind thread)
+        self._buffer: array = array(RECORD_TYPE)
+        self._spare: array = array(RECORD_TYPE)
+
+    def __len__(self) -> int:
+        return len(self._runs)
+
+    def __iter__(self) -> Iterator[TapeRun]:
+        return iter(self._runs)
+
+    def __getitem__(self, i: int) -> TapeRun:
+        return self._runs[i]
+
+    def __repr__(self) -> str:
+        return f"Tape({self.path!r}, runs={len(self._runs)})"
+
+    def _pack_block(self, block: array) -> Union[array, bytes]:
+        """
+        The bytes of `block` in the file: little-endian int64.
+        """
+        if sys.byteorder == "big":
+            block = array(RECORD_TYPE, block)
+            block.byteswap()
+        return block
+
+    def _write_behind(self) -> None:
+        # Runs on the write-behind thread until it gets `None`
+        while True:
+            item = self._write_queue.get()
+            if item is not None:
+                data, num_records = item
+                self._file.write(data)
+                self._file.flush()
+                self._written += num_records
+            self._write_queue.task_done()
+            if item is None:
+                return
+
+    def _write_block(self, block: array) -> None:
+        """
+        Writes `block` and empties it, or hands it to the write-behind
+        thread, in which case a new spare buffer is needed.
+        """
+        data = self._pack_block(block)
+        self._flushed += len(block)
+        self.io.blocks_written += 1
+        self.io.bytes_written += memoryview(data).nbytes
+        self.io.raw_bytes_written += len(block) * RECORD_SIZE
+        if not self.io_depth:
+            # A synchronous write stalls the sort for all its duration
+            start = time.perf_counter()
+            self._file.write(data)
+            self.io.write_stall += time.perf_counter() - start
+            self._written = self._flushed
+            del block[:]
+            self._spare = block
+            return
+
+        if self._writer is None:
+            self._write_queue = queue.Queue(self.io_depth)
+            self._writer = threading.Thread(target=self._write_behind, daemon=True)
+            self._writer.start()
+        start = time.perf_counter()
+        self._write_queue.put((data, len(block)))
+        self.io.write_stall += time.perf_counter() - start
+        self._spare = array(RECORD_TYPE)
+
+    def _write_full_blocks(self) -> None:
+        while len(self._buffer) >= self.block_size:
+            # Swap buffers: the full one is written while the other one fills
+            block, self._buffer = self._buffer, self._spare
+            self._buffer.extend(block[self.block_size:])
+            del block[self.block_size:]
+            self._write_block(block)
+
+    def _wait_writes(self) -> None:
+        if self._writer is not None:
+            start = time.perf_counter()
+            self._write_queue.join()
+            self.io.write_stall += time.perf_counter() - start
+
+    def flush(self) -> None:
+        """
+        Writes the records still buffered, even if they don't fill a block,
+        and waits for the write-behind thread to write them.
+        """
+        if self._buffer:
+            block, self._buffer = self._buffer, self._spare
+            self._write_block(block)
+        self._wait_writes()
+        self._file.flush()
+
+    def _read_ahead(self, offset: int, end: int) -> Iterator[array]:
+        """
+        Yields the blocks of records [offset, end) while a background thread
+        reads the next `io_depth` ones.
+        """
+        if end > self._written:
+            self.flush()
+        blocks: queue.Queue = queue.Queue(self.io_depth)
+        stop = threading.Event()
+
+        def put(block: Optional[array]) -> bool:
+            while not stop.is_set():
+                try:
+                    blocks.put(block, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read() -> None:
+            for block in self._pread_blocks(offset, end):
+                if not put(block):
+                    return
+            put(None)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = blocks.get()
+                self.io.read_stall += time.perf_counter() - start
+                if item is None:
+                    return
+                block, num_bytes = item
+                # no bytes: a block already decoded (`CompressedTape`)
+                self.io.blocks_read += num_bytes > 0
+                self.io.bytes_read += num_bytes
+                self.io.raw_bytes_read += len(block) * RECORD_SIZE
+                yield block
+        finally:
+            # The run may be left half read: let the reader go
+            stop.set()
+
+    def _pread_blocks(self, offset: int, end: int) -> Iterator[Tuple[array, int]]:
+        """
+        Reads the records [offset, end) block by block, with the bytes read
+        for each one. Runs on the read-ahead thread: os.pread releases the
+        GIL, so the merge goes on meanwhile.
+        """
+        fd: int = self._file.fileno()
+        for start in range(offset, end, self.block_size):
+            length: int = min(self.block_size, end - start)
+            block = array(RECORD_TYPE)
+            block.frombytes(os.pread(fd, length * RECORD_SIZE, start * RECORD_SIZE))
+            if sys.byteorder == "big":
+                block.byteswap()
+            yield block, length * RECORD_SIZE
+
+    def _read_block(self, offset: int, length: int, end: int) -> memoryview:
+        if end > self._written:
+            self.flush()
+        if self._mmap is None or len(self._mmap) < self._written * RECORD_SIZE:
+            # The tape grew since it was last mapped
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), self._written * RECORD_SIZE, access=mmap.ACCESS_READ)
+
+        if offset + length < end and hasattr(self._mmap, "madvise"):
+            # Double buffering: prefetch the next block while this one is consumed
+            start = (offset + length) * RECORD_SIZE
+            aligned = start - start % mmap.PAGESIZE
+            self._mmap.madvise(mmap.MADV_WILLNEED, aligned, min(end - offset - length, self.block_size) * RECORD_SIZE + start - aligned)
+
+        self.io.blocks_read += 1
+        self.io.bytes_read += length * RECORD_SIZE
+        self.io.raw_bytes_read += length * RECORD_SIZE
+        return view_records(self._mmap, offset, length)
+
+    def _locate(self, offset: int, length: int) -> Optional[Tuple[str, int, int, int]]:
+        if offset + length > self._written:
+            self.flush()
+        else:
+            # the blocks were written, but maybe only to the file buffer: another process reads the file
+            self._file.flush()
+        self.io.blocks_read += -(-length // self.block_size)
+        self.io.bytes_read += length * RECORD_SIZE
+        self.io.raw_bytes_read += length * RECORD_SIZE
+        return self.path, offset, length, self.block_size
+
+    def _rewind(self) -> None:
+        self._wait_writes()
+        self._mmap = None
+        self._file.seek(0)
+        self._file.truncate()
+        self._size = self._flushed = self._written = 0
+        del self._buffer[:]
+
+    def append(self, run: Iterable[Union[int, float]]) -> int:
+        """
+        Writes `run` at the end of the tape, through the block buffers.
+        Returns the number of records written.
+        """
+        if not self._runs and not self._popped:
+            # Everything on the tape was consumed: rewind it.
+            self._rewind()
+
+        offset: int = self._size
+        length: int = 0
+        if isinstance(run, CountedRun):
+            run = run.records()
+        for chunk in chunk_records(run, self.block_size):
+            self._buffer.extend(chunk)
+            length += len(chunk)
+            self._write_full_blocks()
+        self._size += length
+
+        self._runs.append(TapeRun(self, offset, length))
+        return length
+
+    def pop(self, i: int = 0) -> TapeRun:
+        if i == 0:
+            run = self._runs.popleft()
+        else:
+            run = self._runs[i]
+            del self._runs[i]
+        # It may be read after the tape is appended to: don't rewind under it
+        self._popped.add(run)
+        return run
+
+    def close(self) -> None:
+        self._runs.clear()
+        if self._writer is not None:
+            self._write_queue.put(None)
+            self._writer.join()
+            self._writer = None
+        self._mmap = None
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class CompressedTape(Tape):
+    """
+    A `Tape` whose blocks are delta + varint encoded (see `utils/codec.py`):
+    a run of close registers takes a byte or two per register instead of 8,
+    so every phase moves that many fewer bytes.
+
+    Blocks have a variable size on disk, so the tape keeps a block index in
+    main memory: the first record and the byte offset of each block. A run
+    is read by decoding the blocks it spans, one at a time, with `os.pread`
+    (the kernel is asked to prefetch the next one), or on the read-ahead
+    thread with `io_depth` > 0.
+    """
+    def __init__(self, path: str, block_size: int = BLOCK_RECORDS, io_depth: int = 0) -> None:
+        super().__init__(path, block_size, io_depth)
+        # block i holds the records [_block_starts[i], _block_starts[i + 1]),
+        # in the bytes [_block_offsets[i], _block_offsets[i + 1]) of the file
+        self._block_starts: array = array(RECORD_TYPE, [0])
+        self._block_offsets: array = array(RECORD_TYPE, [0])
+        # the last block decoded: the runs of a tape are read front to back,
+        # so the next run usually starts in the block where this one ended
+        self._decoded: Tuple[int, Optional[array]] = (-1, None)
+
+    def __repr__(self) -> str:
+        return f"CompressedTape({self.path!r}, runs={len(self._runs)})"
+
+    def _pack_block(self, block: array) -> bytes:
+        data = encode_block(block)
+        self._block_starts.append(self._flushed + len(block))
+        self._block_offsets.append(self._block_offsets[-1] + len(data))
+        return data
+
+    def _decode(self, i: int, fd: int) -> Tuple[array, int]:
+        """
+        Block `i`, decoded, and the bytes read for it (none if it was the
+        last block decoded).
+        """
+        decoded_index, block = self._decoded
+        if decoded_index == i:
+            return block, 0
+        num_bytes: int = self._block_offsets[i + 1] - self._block_offsets[i]
+        data = os.pread(fd, num_bytes, self._block_offsets[i])
+        block = decode_block(data, self._block_starts[i + 1] - self._block_starts[i])
+        self._decoded = (i, block)
+        return block, num_bytes
+
+    def _pread_blocks(self, offset: int, end: int) -> Iterator[Tuple[array, int]]:
+        fd: int = self._file.fileno()
+        i: int = bisect_right(self._block_starts, offset) - 1
+        while offset < end:
+            start: int = self._block_starts[i]
+            block, num_bytes = self._decode(i, fd)
+            yield block[offset - start:end - start], num_bytes
+            offset = self._block_starts[i + 1]
+            i += 1
+
+    def _read_block(self, offset: int, length: int, end: int) -> array:
+        if end > self._written:
+            self.flush()
+        elif not self.io_depth:
+            # The synchronous writes may still be in the file buffer
+            self._file.flush()
+        fd: int = self._file.fileno()
+        i: int = bisect_right(self._block_starts, offset) - 1
+        start: int = self._block_starts[i]
+        if self._block_starts[i + 1] < end and hasattr(os, "posix_fadvise"):
+            # Double buffering: prefetch the next block while this one is consumed
+            os.posix_fadvise(fd, self._block_offsets[i + 1], self._block_offsets[i + 2] - self._block_offsets[i + 1], os.POSIX_FADV_WILLNEED)
+        block, num_bytes = self._decode(i, fd)
+        # the run may start or end inside the block
+        block = block[offset - start:offset - start + length]
+        self.io.blocks_read += num_bytes > 0
+        self.io.bytes_read += num_bytes
+        self.io.raw_bytes_read += len(block) * RECORD_SIZE
+        return block
+
+    def _locate(self, offset: int, length: int) -> None:
+        # the block index lives in this process only
+        return None
+
+    def _rewind(self) -> None:
+        super()._rewind()
+        self._block_starts = array(RECORD_TYPE, [0])
+        self._block_offsets = array(RECORD_TYPE, [0])
+        self._decoded = (-1, None)
+
+class MemoryTape:
+    """
+    In-memory stand-in for a `Tape`: a deque of runs (lists), so `pop(0)`
+    only moves the read cursor instead of shifting every run left.
+    """
+    def __init__(self) -> None:
+        self._runs: Deque[List[Union[int, float]]] = deque()
+        self.io: IOCounters = IOCounters() # Always zero: there is no I/O
+
+    def __len__(self) -> int:
+        return len(self._runs)
+
+    def __iter__(self) -> Iterator[List[Union[int, float]]]:
+        return iter(self._runs)
+
+    def __getitem__(self, i: int) -> List[Union[int, float]]:
+        return self._runs[i]
+
+    def __setitem__(self, i: int, run: List[Union[int, float]]) -> None:
+        self._runs[i] = run
+
+    def __repr__(self) -> str:
+        return repr(list(self._runs))
+
+    def append(self, run: Iterable[Union[int, float]]) -> int:
+        if isinstance(run, CountedRun):
+            run = run.records()
+        run = run if isinstance(run, list) else list(run)
+        self._runs.append(run)
+        return len(run)
+
+    def pop(self, i: int = 0) -> List[Union[int, float]]:
+        if i == 0:
+            return self._runs.popleft()
+        if i == -1:
+            return self._runs.pop()
+        run = self._runs[i]
+        del self._runs[i]
+        return run
+
+    def close(self) -> None:
+        self._runs.clear()
+
+class RecordRun:
+    """
+    A run of key/payload records stored on a `RecordTape`. Holding it costs
+    O(1) memory: the records are unpacked from the memory-mapped tape as
+    the run is iterated.
+    """
+    def __init__(self, tape: 'RecordTape', offset: int, num_bytes: int, length: int) -> None:
+        self._tape: 'RecordTape' = tape
+        self._offset: int = offset # in bytes
+        self._num_bytes: int = num_bytes
+        self._length: int = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[Record]:
+        return self._tape._read_run(self._offset, self._num_bytes, self._length)
+
+    def __repr__(self) -> str:
+        return str(list(self))
+
+class RecordTape:
+    """
+    A `Tape` of key/payload records, packed by `layout` (see
+    `utils/records.py`). Blocks hold `block_size` whole records, payloads
+    included, so `io` counts the real bytes moved.
+    """
+    def __init__(self, path: str, layout: RecordLayout, block_size: int = BLOCK_RECORDS) -> None:
+        if block_size < 1:
+            raise ValueError("A block must hold at least one record")
+
+        self.path: str = path
+        self.layout: RecordLayout = layout
+        self.block_size: int = block_size
+        self.io: IOCounters = IOCounters()
+        self._runs: Deque[RecordRun] = deque()
+        self._popped: weakref.WeakSet = weakref.WeakSet() # popped runs still referenced
+        self._file = open(path, 'w+b')
+        self._mmap: Optional[mmap.mmap] = None
+        self._size: int = 0 # bytes appended
+        self._written: int = 0 # bytes in the file
+        self._buffer: bytearray = bytearray()
+        self._buffered: int = 0 # records in `_buffer`
+
+    def __len__(self) -> int:
+        return len(self._runs)
+
+    def __iter__(self) -> Iterator[RecordRun]:
+        return iter(self._runs)
+
+    def __getitem__(self, i: int) -> RecordRun:
+        return self._runs[i]
+
+    def __repr__(self) -> str:
+        return f"RecordTape({self.path!r}, runs={len(self._runs)})"
+
+    def _write_buffer(self) -> None:
+        if not self._buffer:
+            return
+        self._file.write(self._buffer)
+        self.io.blocks_written += 1
+        self.io.bytes_written += len(self._buffer)
+        self.io.raw_bytes_written += len(self._buffer)
+        self._written += len(self._buffer)
+        self._buffer = bytearray()
+        self._buffered = 0
+
+    def flush(self) -> None:
+        self._write_buffer()
+        self._file.flush()
+
+    def _read_run(self, offset: int, num_bytes: int, length: int) -> Iterator[Record]:
+        if length == 0:
+            return
+        if offset + num_bytes > self._written:
+            self.flush()
+            self._mmap = None
+        if self._mmap is None or len(self._mmap) < offset + num_bytes:
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.io.blocks_read += -(-length // self.block_size)
+        self.io.bytes_read += num_bytes
+        self.io.raw_bytes_read += num_bytes
+        view = memoryview(self._mmap)[offset:offset + num_bytes]
+        try:
+            yield from self.layout.unpack(view, length)
+        finally:
+            view.release()
+
+    def append(self, run: Iterable[Record]) -> int:
+        """
+        Writes `run` at the end of the tape, a block at a time. Returns the
+        number of records written.
+        """
+        if not self._runs and not self._popped:
+            # Everything on the tape was consumed: rewind it.
+            self._mmap = None
+            self._file.seek(0)
+            self._file.truncate()
+            self._size = self._written = self._buffered = 0
+            self._buffer = bytearray()
+
+        offset: int = self._size
+        start: int = len(self._buffer) + self._written
+        length: int = 0
+        for record in run:
+            self.layout.pack_into(self._buffer, record)
+            length += 1
+            self._buffered += 1
+            if self._buffered >= self.block_size:
+                self._write_buffer()
+        self._size = len(self._buffer) + self._written
+
+        self._runs.append(RecordRun(self, offset, self._size - start, length))
+        return length
+
+    def pop(self, i: int = 0) -> RecordRun:
+        if i == 0:
+            run = self._runs.popleft()
+        else:
+            run = self._runs[i]
+            del self._runs[i]
+        self._popped.add(run)
+        return run
+
+    def close(self) -> None:
+        self._runs.clear()
+        self._mmap = None
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+Entry = Tuple[int, int]
+
+_NO_VALUE = object()
+
+def count_records(run: Iterable) -> Iterator[Entry]:
+    """
+    The (value, count) entries of the sorted `run`, given as registers, as
+    entries (e.g. a merge of counted runs) or as a `CountedRun`. Adjacent
+    entries of the same value are combined.
+    """
+    it = iter(run)
+    first = next(it, _NO_VALUE)
+    if first is _NO_VALUE:
+        return
+    if not isinstance(first, tuple):
+        for value, group in groupby(chain((first,), it)):
+            yield value, sum(1 for _ in group)
+        return
+
+    value, count = first
+    for entry_value, entry_count in it:
+        if entry_value == value:
+            count += entry_count
+        else:
+            yield value, count
+            value, count = entry_value, entry_count
+    yield value, count
+
+class CountedRun:
+    """
+    A run stored as (value, count) entries, in value order: iterating it
+    yields the entries, so moving (or merging, by `record_key`) a run of
+    many duplicates costs one entry per distinct value. `len` is still its
+    number of records, which is what the phases count.
+
+    On a `CountedTape` on disk the entries are kept flat, as value, count,
+    value, count... on a `Tape` of int64 registers.
+    """
+    def __init__(self, entries: Iterable, length: int, flat: bool = False) -> None:
+        self._entries = entries
+        self._length: int = length
+        self._flat: bool = flat
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[Entry]:
+        if self._flat:
+            it = iter(self._entries)
+            return zip(it, it)
+        return iter(self._entries)
+
+    @property
+    def num_entries(self) -> int:
+        return len(self._entries) // 2 if self._flat else len(self._entries)
+
+    def records(self) -> Iterator[int]:
+        """
+        The registers of the run, each value repeated `count` times.
+        """
+        return chain.from_iterable(repeat(value, count) for value, count in self)
+
+    def __repr__(self) -> str:
+        return str(list(self.records()))
+
+class CountedTape:
+    """
+    A tape (`MemoryTape` or `Tape`) of `CountedRun`s. Runs of registers or
+    of entries are counted as they are appended, so a merge of counted runs
+    is written with one entry per distinct value. `append` returns the
+    records written, not the entries, so alpha and beta are unchanged.
+    """
+    def __init__(self, tape: Union[Tape, MemoryTape]) -> None:
+        self.tape: Union[Tape, MemoryTape] = tape
+        self._flat: bool = isinstance(tape, Tape)
+        self._runs: Deque[CountedRun] = deque()
+
+    @property
+    def io(self) -> IOCounters:
+        return self.tape.io
+
+    def __len__(self) -> int:
+        return len(self._runs)
+
+    def __iter__(self) -> Iterator[CountedRun]:
+        return iter(self._runs)
+
+    def __getitem__(self, i: int) -> CountedRun:
+        return self._runs[i]
+
+    def __repr__(self) -> str:
+        return f"CountedTape({self.tape!r})"
+
+    def append(self, run: Iterable) -> int:
+        length: int = 0
+        if not self._flat:
+            entries = list(count_records(run))
+            length = sum(count for _, count in entries)
+            self.tape.append(entries)
+            self._runs.append(CountedRun(entries, length))
+            return length
+
+        def flat() -> Iterator[int]:
+            nonlocal length
+            for value, count in count_records(run):
+                length += count
+                yield value
+                yield count
+
+        self.tape.append(flat())
+        self._runs.append(CountedRun(self.tape[-1], length, flat=True))
+        return length
+
+    def pop(self, i: int = 0) -> CountedRun:
+        self.tape.pop(i)
+        if i == 0:
+            return self._runs.popleft()
+        run = self._runs[i]
+        del self._runs[i]
+        return run
+
+    def close(self) -> None:
+        self._runs.clear()
+        self.tape.close()
+
+def make_tapes(num_tapes: int, tape_dir: Optional[str] = None, block_size: int = BLOCK_RECORDS,
+               io_depth: int = 0, layout: Optional[RecordLayout] = None,
+               counted: bool = False, compress: bool = False) -> List[Union[Tape, RecordTape, MemoryTape, CountedTape]]:
+    """
+    Creates `num_tapes` empty tapes. If `tape_dir` is None they are kept in
+    main memory, otherwise each one is a file inside a fresh scratch
+    directory created under `tape_dir`, doing I/O in blocks of `block_size`
+    records, on background threads queueing up to `io_depth` blocks if
+    `io_depth` > 0. With a `layout` the tapes hold key/payload records
+    (`RecordTape`) instead of int64 registers, with `counted` runs of
+    (value, count) entries (`CountedTape`) and with `compress` their
+    blocks are delta + varint encoded (`CompressedTape`).
+    """
+    if counted and layout is not None:
+        raise ValueError("Counted runs only hold int registers, not key/payload records")
+    if compress and (tape_dir is None or layout is not None):
+        raise ValueError("Only tapes of int registers on disk are compressed")
+    if tape_dir is None:
+        tapes = [MemoryTape() for _ in range(num_tapes)]
+        return [CountedTape(tape) for tape in tapes] if counted else tapes
+
+    os.makedirs(tape_dir, exist_ok=True)
+    scratch_dir: str = tempfile.mkdtemp(prefix="tapes-", dir=tape_dir)
+    if layout is not None:
+        return [RecordTape(os.path.join(scratch_dir, f"tape_{i}"), layout, block_size) for i in range(num_tapes)]
+    tape_type = CompressedTape if compress else Tape
+    tapes = [tape_type(os.path.join(scratch_dir, f"tape_{i}"), block_size, io_depth) for i in range(num_tapes)]
+    return [CountedTape(tape) for tape in tapes] if counted else tapes
+
+def split_memory(memory_size: int, num_tapes: int, block_size: int = BLOCK_RECORDS) -> Tuple[int, int]:
+    """
+    Splits a main memory of `memory_size` records between the replacement
+    selection heap and two buffers (double buffering) of `block_size`
+    records per tape. Blocks are shrunk if needed so that the heap keeps at
+    least half of the memory. Returns (heap size, block size).
+    """
+    block_size = max(1, min(block_size, memory_size // (4 * num_tapes)))
+    return max(1, memory_size - 2 * num_tapes * block_size), block_size
+
+def io_totals(tapes: Iterable[Union[Tape, MemoryTape]]) -> IOCounters:
+    """
+    Sums the I/O counters of `tapes`.
+    """
+    total = IOCounters()
+    for tape in tapes:
+        total = total + tape.io
+    return total
+
+def close_tapes(tapes: List[Union[Tape, MemoryTape]]) -> None:
+    """
+    Closes the tapes created by `make_tapes`, removing their scratch directory.
+    """
+    scratch_dirs = {os.path.dirname(t.path) for t in (getattr(t, "tape", t) for t in tapes) if isinstance(t, (Tape, RecordTape))}
+    for tape in tapes:
+        tape.close()
+    for d in scratch_dirs:
+        shutil.rmtree(d, ignore_errors=True)
+
+class IOTracker:
+    """
+    Splits the I/O of a set of tapes, and the wall time, per phase. The
+    time of a phase not stalled on I/O (`io.stall`) was spent merging.
+    """
+    def __init__(self, tapes: List[Union[Tape, MemoryTape]]) -> None:
+        self._tapes = tapes
+        self._last: IOCounters = io_totals(tapes)
+        self._start: float = time.perf_counter()
+        self.per_phase: List[IOCounters] = []
+        self.seconds: List[float] = []
+
+    def end_phase(self) -> IOCounters:
+        """
+        Records (and returns) the I/O done since the end of the previous phase.
+        """
+        now = io_totals(self._tapes)
+        self.per_phase.append(now - self._last)
+        self._last = now
+        end = time.perf_counter()
+        self.seconds.append(end - self._start)
+        self._start = end
+        return self.per_phase[-1]
+
+    def exclude(self) -> None:
+        """
+        Leaves the I/O done since the end of the last phase out of the next
+        one (e.g. reading the tapes to print them).
+        """
+        self._last = io_totals(self._tapes)
+        self._start = time.perf_counter()
+
+    def report(self) -> str:
+        """
+        One line per phase: wall time, time stalled on I/O and time merging.
+        """
+        return "\n".join(
+            f"fase {phase}: {seconds:.3f}s, stalled {io.stall:.3f}s (read {io.read_stall:.3f}s, write {io.write_stall:.3f}s), merging {seconds - io.stall:.3f}s"
+            for phase, (io, seconds) in enumerate(zip(self.per_phase, self.seconds))
+        )
+
+if __name__ == "__main__":
+    from utils.merge import merge_runs
+
+    for io_depth, compress in ((0, False), (2, False), (0, True), (2, True)):
+        tapes = make_tapes(2, tempfile.gettempdir(), block_size=2, io_depth=io_depth, compress=compress)
+        tapes[0].append([1, 4, 7])
+        tapes[0].append([2, 3, 9])
+        print(tapes[0], [list(r) for r in tapes[0]])
+        tapes[1].append(merge_runs([tapes[0].pop(0), tapes[0].pop(0)]))
+        print(tapes[1], list(tapes[1][0]))
+        print(io_totals(tapes))
+        close_tapes(tapes)
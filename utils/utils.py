@@ -2,7 +2,6 @@ from typing import *
 import random
 from math import inf
 
-import sys, os
 
 def seq_to_notation(seqs: List[List[List[int]]]):
     n_files = len(seqs)
@@ -37,7 +36,10 @@ def beta(main_memory_size: int, num_sequences_actual_phase:int,
                 sum_size_of_generated_sequences += len(seq)
     else:
         raise ValueError("Depth parameter value is wrong or the type of the generated_sequences_at_actual_phase is not correct.")
-    
+
+    if num_sequences_actual_phase == 0:
+        # an empty input has no sequences
+        return 0.0
     return (1/(main_memory_size * num_sequences_actual_phase)) * sum_size_of_generated_sequences
 
 def get_random_num(max_val: int = 100) -> int:
@@ -69,6 +71,23 @@ def generate_sequences_to_tests(main_memory_size: int, num_sorted_sequences: int
     return sequences
 
 
+def read_registers(stream: TextIO, chunk_size: int = 1 << 16) -> Iterator[int]:
+    """
+    Lazily parses whitespace separated registers from a text stream (a file,
+    stdin...), reading it `chunk_size` characters at a time.
+    """
+    tail = ""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        tokens = (tail + chunk).split()
+        # the last token may continue on the next chunk
+        tail = tokens.pop() if tokens and not chunk[-1].isspace() else ""
+        yield from map(int, tokens)
+    if tail:
+        yield int(tail)
+
 def argmin(arr: List[int]) -> int:
     min = inf
     idx = -1
@@ -78,12 +97,3 @@ def argmin(arr: List[int]) -> int:
             min = arr[i]
             idx = i
     return idx
-
-def togglePrint():
-    """
-    Enable/disable printing.
-    """
-    if sys.stdout == sys.__stdout__:
-        sys.stdout = open(os.devnull, 'w')
-    else:
-        sys.stdout = sys.__stdout__